@@ -2,10 +2,15 @@ package com.samsung.health.mysteps.data.api
 
 import com.samsung.health.mysteps.data.model.ChatRequest
 import com.samsung.health.mysteps.data.model.ChatResponse
+import com.samsung.health.mysteps.data.model.WarmupRequest
 import retrofit2.http.Body
 import retrofit2.http.POST
 
 interface ChatApiService {
     @POST("chat")
     suspend fun sendMessage(@Body request: ChatRequest): ChatResponse
+
+    // 채팅 화면이 열릴 때 서버가 사용자 데이터를 미리 준비하도록 요청합니다.
+    @POST("warmup")
+    suspend fun warmup(@Body request: WarmupRequest)
 }
\ No newline at end of file
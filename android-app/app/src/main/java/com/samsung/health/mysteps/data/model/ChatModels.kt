@@ -8,6 +8,12 @@ data class ChatRequest(
     val healthData: Map<String, Any>? = null // 널 허용 타입으로 추가
 )
 
+// 채팅 화면 진입 시 서버 워밍업 요청 모델
+data class WarmupRequest(
+    val userId: String,
+    val sessionId: String
+)
+
 // 서버로부터 받을 응답 모델
 data class ChatResponse(
     val chatResponse: String
@@ -23,6 +23,7 @@ import com.samsung.health.mysteps.data.model.HeartRateData
 import com.samsung.health.mysteps.data.model.Sender
 import com.samsung.health.mysteps.data.model.SleepData
 import com.samsung.health.mysteps.data.model.StepData
+import com.samsung.health.mysteps.data.model.WarmupRequest
 import com.samsung.health.mysteps.domain.ArePermissionsGrantedUseCase
 import com.samsung.health.mysteps.domain.ReadSleepDataUseCase
 import com.samsung.health.mysteps.domain.ReadStepDataUseCase
@@ -212,6 +213,9 @@ class MainViewModel @Inject constructor(
             finalSleepData = state.value.sleepData
         }
 
+        // 서버가 지난 날짜의 데이터도 해당 날짜로 집계할 수 있도록 데이터 날짜를 함께 보냅니다.
+        payload["data_date"] = (date ?: _selectedDate.value).toString()
+
         val exerciseData = mapOf(
             "exercise_type" to "STEPS_DAILY",
             "stats" to mapOf(
@@ -236,6 +240,14 @@ class MainViewModel @Inject constructor(
 
     fun showChat() {
         _isChatVisible.value = true
+        // 첫 메시지 응답이 빨라지도록 서버에 미리 사용자 데이터를 준비해달라고 요청합니다. (실패해도 채팅에는 영향 없음)
+        viewModelScope.launch {
+            try {
+                chatApiService.warmup(WarmupRequest(userId = userId, sessionId = sessionId))
+            } catch (e: Exception) {
+                Log.w(TAG, "서버 워밍업 요청 실패: ${e.message}")
+            }
+        }
     }
 
     fun hideChat() {
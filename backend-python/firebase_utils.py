@@ -2,9 +2,20 @@
 
 import firebase_admin
 from firebase_admin import credentials, firestore
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
 import json
+import uuid
 from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+from shared_state import get_shared_state
+from util import extract_health_metrics, health_data_date
+
+# 공유 캐시에 보관하는 값들의 유효 시간(초)
+USER_STATUS_CACHE_TTL = 300
+USER_PROFILE_CACHE_TTL = 600
+HISTORY_CACHE_TTL = 300
+# 대화 기록은 이 개수만큼 캐시해두고, 더 적은 개수를 요청하면 잘라서 반환합니다.
+HISTORY_CACHE_LIMIT = 10
 
 
 def initialize_firebase():
@@ -23,34 +34,113 @@ def initialize_firebase():
     return firestore.client()
 
 
-def save_analysis_json(db, user_id: str, session_id: str, analysis_data: dict):
+def save_analysis_json(db, user_id: str, session_id: str, analysis_data: dict, health_data: dict | None = None):
     """
     구조화된 JSON 분석 결과를 Firestore에 저장합니다.
+    health_data가 주어지면 수치 지표를 함께 저장하고, 데이터 날짜의 일별/주별 롤업을 갱신합니다.
     """
-    # 문서 ID를 타임스탬프로 하여 시간순 정렬이 용이하게 함
-    doc_id = datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
+    now = datetime.now()
+    # 문서 ID를 타임스탬프로 하여 시간순 정렬이 용이하게 함 (같은 초에 저장되어도 겹치지 않도록 마이크로초까지 포함)
+    doc_id = now.strftime("%Y-%m-%d_%H:%M:%S.%f")
     doc_ref = db.collection('users').document(
         user_id).collection('analysis_history').document(doc_id)
 
+    metrics = extract_health_metrics(health_data)
+    # 지난 날짜의 데이터를 오늘 분석해도 그 날짜로 집계되도록, 분석 시각이 아닌 데이터의 날짜를 사용합니다.
+    data_date = health_data_date(health_data) or now.strftime("%Y-%m-%d")
+    analysis_data['session_id'] = session_id
+    analysis_data['date'] = data_date
+    analysis_data['metrics'] = metrics
     analysis_data['timestamp'] = firestore.SERVER_TIMESTAMP
     doc_ref.set(analysis_data)
+    if metrics:
+        _update_analysis_rollups(db, user_id, metrics, data_date)
     print(f"✅ Firestore에 분석 결과 저장 완료: {user_id}/{doc_id}")
 
 
+def _rollup_period_starts(day: date) -> dict[str, str]:
+    """해당 날짜가 속한 일별/주별(월요일 시작) 롤업 기간의 시작 날짜를 반환합니다."""
+    week_start = day - timedelta(days=day.weekday())
+    return {"daily": day.isoformat(), "weekly": week_start.isoformat()}
+
+
+def _update_analysis_rollups(db, user_id: str, metrics: dict, data_date: str):
+    """
+    데이터 날짜의 일별 롤업 문서와, 그 날짜가 속한 주별 롤업 문서의 해당 날짜 항목을 최신 지표로 덮어씁니다.
+    같은 날짜의 데이터를 다시 분석해도 값이 중복 집계되지 않습니다.
+    추이 조회 시에는 분석 문서를 모두 읽지 않고 롤업 문서만 읽습니다.
+    """
+    periods = _rollup_period_starts(date.fromisoformat(data_date))
+    rollups_ref = db.collection('users').document(user_id).collection('analysis_rollups')
+    batch = db.batch()
+    batch.set(rollups_ref.document(f"daily_{periods['daily']}"), {
+        'granularity': 'daily',
+        'period_start': periods['daily'],
+        'metrics': metrics,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    })
+    # 주별 문서의 다른 날짜 항목은 유지하고, 이 날짜 항목만 통째로 교체합니다.
+    day_path = FieldPath('days', data_date).to_api_repr()
+    batch.set(rollups_ref.document(f"weekly_{periods['weekly']}"), {
+        'granularity': 'weekly',
+        'period_start': periods['weekly'],
+        'days': {data_date: metrics},
+        'updated_at': firestore.SERVER_TIMESTAMP
+    }, merge=['granularity', 'period_start', day_path, 'updated_at'])
+    batch.commit()
+
+
+def get_metric_rollups(db, user_id: str, metric: str, granularity: str = "weekly", periods: int = 4) -> list[dict]:
+    """
+    최근 periods개 기간(일별 또는 주별)의 지표 평균을 오래된 순으로 반환합니다.
+    기간별 롤업 문서를 ID로 바로 조회하므로, 분석 기록이 많아도 읽는 문서 수는 periods개입니다.
+    count는 해당 기간 중 지표가 있는 날의 수입니다.
+    """
+    step = timedelta(days=7) if granularity == "weekly" else timedelta(days=1)
+    current = date.fromisoformat(_rollup_period_starts(date.today())[granularity])
+    period_starts = [(current - step * i).isoformat() for i in reversed(range(periods))]
+
+    rollups_ref = db.collection('users').document(user_id).collection('analysis_rollups')
+    refs = [rollups_ref.document(f"{granularity}_{start}") for start in period_starts]
+    docs = {doc.id: doc.to_dict() for doc in db.get_all(refs) if doc.exists}
+
+    results = []
+    for start in period_starts:
+        data = docs.get(f"{granularity}_{start}", {})
+        if granularity == "weekly":
+            day_metrics = data.get('days', {}).values()
+        else:
+            day_metrics = [data['metrics']] if data.get('metrics') else []
+        values = [day[metric] for day in day_metrics if day.get(metric) is not None]
+        results.append({
+            'period_start': start,
+            'average': round(sum(values) / len(values), 2) if values else None,
+            'count': len(values)
+        })
+    return results
+
+
 def get_user_status(db, user_id: str) -> str:
     """
     Firestore에서 사용자의 현재 대화 상태를 가져옵니다.
     상태가 없으면 'NEEDS_ANALYSIS'를 기본값으로 반환합니다.
     """
-    doc_ref = db.collection('users').document(user_id)
-    doc = doc_ref.get()
-    if doc.exists:
-        # to_dict()의 get 메서드를 사용하여 'status' 키가 없을 경우 기본값 반환
-        return doc.to_dict().get('status', 'NEEDS_ANALYSIS')
-    else:
-        # 사용자가 아예 존재하지 않는 경우
-        return 'NEEDS_ANALYSIS'
-    
+    def load_status():
+        doc_ref = db.collection('users').document(user_id)
+        doc = doc_ref.get()
+        if doc.exists:
+            # to_dict()의 get 메서드를 사용하여 'status' 키가 없을 경우 기본값 반환
+            return doc.to_dict().get('status', 'NEEDS_ANALYSIS')
+        else:
+            # 사용자가 아예 존재하지 않는 경우
+            return 'NEEDS_ANALYSIS'
+
+    cache = get_shared_state()
+    # 메모리 백엔드에서는 별도 프로세스(선제적 분석 CLI 워커 등)가 바꾼 상태를 알 수 없으므로 캐시하지 않습니다.
+    if not cache.is_shared:
+        return load_status()
+    return cache.get_or_load(f"user_status:{user_id}", load_status, USER_STATUS_CACHE_TTL)
+
 
 def update_user_status(db, user_id: str, new_status: str):
     """
@@ -59,6 +149,10 @@ def update_user_status(db, user_id: str, new_status: str):
     doc_ref = db.collection('users').document(user_id)
     # set 메서드에 merge=True를 사용하여 다른 필드는 유지하고 status 필드만 추가/수정
     doc_ref.set({'status': new_status}, merge=True)
+    # 다른 워커/노드가 이전 상태를 사용하지 않도록 공유 캐시도 함께 갱신합니다.
+    cache = get_shared_state()
+    if cache.is_shared:
+        cache.set(f"user_status:{user_id}", new_status, USER_STATUS_CACHE_TTL)
     print(f"✅ 사용자 '{user_id}'의 상태를 '{new_status}'(으)로 업데이트했습니다.")
 
 
@@ -66,13 +160,16 @@ def get_user_profile(db, user_id: str) -> dict | None:
     """
     Firestore에서 사용자 프로필 정보를 가져옵니다. 없으면 None을 반환합니다.
     """
-    doc_ref = db.collection('users').document(user_id)
-    doc = doc_ref.get()
-    if doc.exists and doc.to_dict().get('profile'):
-        return doc.to_dict()['profile']
-    else:
-        # 프로필이 없으면 None을 반환
-        return None
+    def load_profile():
+        doc_ref = db.collection('users').document(user_id)
+        doc = doc_ref.get()
+        if doc.exists and doc.to_dict().get('profile'):
+            return doc.to_dict()['profile']
+        else:
+            # 프로필이 없으면 None을 반환
+            return None
+
+    return get_shared_state().get_or_load(f"user_profile:{user_id}", load_profile, USER_PROFILE_CACHE_TTL)
 
 
 def save_conversation_turn(db, user_id: str, session_id: str, user_query: str, ai_response: str):
@@ -89,6 +186,11 @@ def save_conversation_turn(db, user_id: str, session_id: str, user_query: str, a
         'timestamp': firestore.SERVER_TIMESTAMP
     }
     doc_ref.set(turn_data)
+    cache = get_shared_state()
+    if cache.is_shared:
+        # 기록 세대를 먼저 바꾼 뒤 캐시를 지워, 이 저장 전에 시작된 조회가 오래된 기록을 다시 캐시하지 않도록 합니다.
+        cache.set(f"conversation_history_generation:{user_id}", uuid.uuid4().hex, HISTORY_CACHE_TTL)
+        cache.delete(f"conversation_history:{user_id}")
     print(f"💬 Firestore에 대화 저장 완료: {user_id}/{session_id}/{timestamp_doc_id}")
 
 
@@ -96,6 +198,24 @@ def get_conversation_history(db, user_id: str, limit: int = 10) -> list:
     """
     Firestore에서 특정 사용자의 모든 세션을 통틀어 최근 대화 기록을 가져옵니다.
     """
+    cache = get_shared_state()
+    # 메모리 백엔드에서는 다른 프로세스가 저장한 대화를 알 수 없으므로 캐시하지 않습니다. (get_user_status와 동일)
+    if limit > HISTORY_CACHE_LIMIT or not cache.is_shared:
+        return _load_conversation_history(db, user_id, limit)
+    key = f"conversation_history:{user_id}"
+    history = cache.get(key)
+    if history is None:
+        generation_key = f"conversation_history_generation:{user_id}"
+        generation = cache.get(generation_key)
+        history = _load_conversation_history(db, user_id, HISTORY_CACHE_LIMIT)
+        # 조회하는 동안 새 대화가 저장되었으면(세대가 바뀜) 방금 읽은 기록은 이미 오래되었으므로 캐시하지 않습니다.
+        if cache.get(generation_key) == generation:
+            cache.set(key, history, HISTORY_CACHE_TTL)
+    # 한 턴은 User/AI 두 줄로 구성되므로, 최근 limit개의 턴만 남깁니다.
+    return history[-limit * 2:] if limit > 0 else []
+
+
+def _load_conversation_history(db, user_id: str, limit: int) -> list:
     history_ref = db.collection_group('conversation_history').where(
         filter=FieldFilter('user_id', '==', user_id)
     ).order_by(
@@ -117,3 +237,92 @@ def get_conversation_history(db, user_id: str, limit: int = 10) -> list:
         history.append(f"AI: {ai_text}")
 
     return list(reversed(history))
+
+
+def save_latest_health_data(db, user_id: str, health_data: dict):
+    """
+    앱에서 전달받은 최신 건강 데이터를 사용자별 스냅샷 문서(users/{uid}/health_snapshots/latest)에 저장합니다.
+    사용자 문서에는 갱신 시각만 남겨, 요청마다 사용자 문서를 읽을 때 큰 데이터를 함께 읽지 않도록 합니다.
+    선제적 분석 스케줄러가 '새 데이터가 있는 사용자'를 고를 때 이 시각을 사용합니다.
+    """
+    user_ref = db.collection('users').document(user_id)
+    batch = db.batch()
+    batch.set(user_ref.collection('health_snapshots').document('latest'), {
+        'health_data': health_data,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    })
+    batch.set(user_ref, {
+        'health_data_updated_at': firestore.SERVER_TIMESTAMP,
+        # 이전 버전에서 사용자 문서에 저장하던 데이터는 지웁니다.
+        'latest_health_data': firestore.DELETE_FIELD
+    }, merge=True)
+    batch.commit()
+
+
+def get_latest_health_data(db, user_id: str) -> dict | None:
+    """save_latest_health_data로 저장된 최신 건강 데이터를 반환합니다. 없으면 None을 반환합니다."""
+    doc = db.collection('users').document(user_id).collection('health_snapshots').document('latest').get()
+    return doc.to_dict().get('health_data') if doc.exists else None
+
+
+def get_users_by_status(db, status: str, fields: list[str] | None = None, page_size: int = 500) -> list[tuple[str, dict]]:
+    """
+    특정 대화 상태에 있는 모든 사용자의 (user_id, 문서 데이터) 목록을 반환합니다.
+    fields가 주어지면 해당 필드만 읽으며, 사용자가 많아도 page_size개씩 나누어 조회합니다.
+    """
+    query = db.collection('users').where(filter=FieldFilter('status', '==', status))
+    if fields:
+        query = query.select(fields)
+    query = query.order_by(FieldPath.document_id()).limit(page_size)
+
+    users = []
+    last_doc = None
+    while True:
+        page = list((query.start_after(last_doc) if last_doc else query).stream())
+        users.extend((doc.id, doc.to_dict()) for doc in page)
+        if len(page) < page_size:
+            return users
+        last_doc = page[-1]
+
+
+def try_acquire_lease(db, name: str, holder: str, ttl_seconds: float) -> bool:
+    """
+    여러 워커/서버 중 하나만 작업을 실행하도록 Firestore 문서(scheduler_leases/{name})로 임대를 잡습니다.
+    임대가 비어 있거나 만료되었거나 이미 holder가 가지고 있으면 ttl_seconds만큼 (다시) 잡고 True를 반환합니다.
+    """
+    lease_ref = db.collection('scheduler_leases').document(name)
+
+    @firestore.transactional
+    def acquire(transaction) -> bool:
+        snapshot = lease_ref.get(transaction=transaction)
+        now = datetime.now(timezone.utc)
+        lease = snapshot.to_dict() if snapshot.exists else {}
+        if lease.get('holder') not in (None, holder) and lease.get('expires_at') and lease['expires_at'] > now:
+            return False
+        transaction.set(lease_ref, {'holder': holder, 'expires_at': now + timedelta(seconds=ttl_seconds)})
+        return True
+
+    return acquire(db.transaction())
+
+
+def mark_proactive_analysis_done(db, user_id: str):
+    """
+    선제적 분석이 끝난 시각을 기록하여, 다음 실행 때 새 데이터가 없으면 건너뛰도록 합니다.
+    """
+    doc_ref = db.collection('users').document(user_id)
+    doc_ref.set({'last_proactive_analysis_at': firestore.SERVER_TIMESTAMP}, merge=True)
+
+
+def enqueue_notification(db, user_id: str, title: str, body: str, priority: int):
+    """
+    앱으로 전송할 알림을 사용자별 알림 대기열에 추가합니다. (priority가 낮을수록 먼저 전송)
+    """
+    doc_ref = db.collection('users').document(user_id).collection('notification_queue').document()
+    doc_ref.set({
+        'title': title,
+        'body': body,
+        'priority': priority,
+        'delivered': False,
+        'created_at': firestore.SERVER_TIMESTAMP
+    })
+    print(f"🔔 알림 대기열에 추가 완료: {user_id} (우선순위 {priority}) '{title}'")
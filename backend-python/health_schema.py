@@ -0,0 +1,109 @@
+# health_schema.py
+
+from typing import List, Dict, Optional, Union
+from pydantic import BaseModel, ConfigDict, Field
+
+# 정수로 들어온 값은 정수 그대로, 소수는 소수로 유지합니다.
+Number = Union[int, float]
+
+
+class _HealthModel(BaseModel):
+    # 앱이 새 필드를 추가해도 요청이 거부되지 않도록, 정의되지 않은 필드는 그대로 보존합니다.
+    model_config = ConfigDict(extra="allow")
+
+
+class UserProfile(_HealthModel):
+    user_id: Optional[str] = None
+    age: Optional[int] = None
+    gender: Optional[str] = None
+    height_cm: Optional[Number] = None
+    weight_kg: Optional[Number] = None
+
+
+class TimeseriesPoint(_HealthModel):
+    time: str
+    heart_rate: Optional[Number] = None
+    stress: Optional[Number] = None
+
+
+class SleepStage(_HealthModel):
+    stage: str
+    duration_minutes: Number
+
+
+class SleepData(_HealthModel):
+    start_time: Optional[str] = None
+    end_time: Optional[str] = None
+    duration_minutes: Optional[Number] = None
+    stages: List[SleepStage] = Field(default_factory=list)
+
+
+class ExerciseStats(_HealthModel):
+    total_steps: Optional[int] = None
+    goal: Optional[int] = None
+    hourly_steps: Optional[Dict[str, int]] = None
+    calories_burned: Optional[Number] = None
+    distance_meters: Optional[Number] = None
+
+
+class ExerciseSession(_HealthModel):
+    exercise_type: str
+    start_time: Optional[str] = None
+    end_time: Optional[str] = None
+    stats: ExerciseStats = Field(default_factory=ExerciseStats)
+
+
+class Meal(_HealthModel):
+    time: Optional[str] = None
+    description: Optional[str] = None
+    calories: Optional[Number] = None
+
+
+class NutritionData(_HealthModel):
+    meals: List[Meal] = Field(default_factory=list)
+    hydration_liters: Optional[Number] = None
+
+
+class BloodPressure(_HealthModel):
+    time: str
+    systolic: Number
+    diastolic: Number
+
+
+class BloodGlucose(_HealthModel):
+    time: str
+    value: Optional[Number] = None
+
+
+class OxygenSaturation(_HealthModel):
+    time: str
+    percentage: Number
+
+
+class VitalsData(_HealthModel):
+    blood_pressure: List[BloodPressure] = Field(default_factory=list)
+    blood_glucose: List[BloodGlucose] = Field(default_factory=list)
+    oxygen_saturation: List[OxygenSaturation] = Field(default_factory=list)
+
+
+class UserPreferences(_HealthModel):
+    likes: List[str] = Field(default_factory=list)
+    dislikes: List[str] = Field(default_factory=list)
+
+
+class HealthData(_HealthModel):
+    """앱이 /chat으로 보내는 건강 데이터 (data/sample_data.json 형식)"""
+    # 데이터가 속한 날짜 (YYYY-MM-DD). 앱에서 선택한 날짜이며, 분석 롤업을 이 날짜 기준으로 집계합니다.
+    data_date: Optional[str] = None
+    user_profile: Optional[UserProfile] = None
+    timeseries_data: Optional[List[TimeseriesPoint]] = None
+    sleep_data: Optional[SleepData] = None
+    exercise_data: Optional[List[ExerciseSession]] = None
+    nutrition_data: Optional[NutritionData] = None
+    vitals_data: Optional[VitalsData] = None
+    user_preferences: Optional[UserPreferences] = None
+
+    def to_payload(self) -> dict:
+        """다른 모듈(데이터 충분성 검사, 프롬프트, Firestore)에서 사용하는 dict 형태로 변환합니다."""
+        # 앱이 실제로 보낸 필드만 포함하여, 기본값으로 채워진 빈 필드가 데이터 검사에 영향을 주지 않도록 합니다.
+        return self.model_dump(exclude_unset=True)
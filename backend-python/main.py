@@ -1,111 +1,267 @@
 # main.py
 
 import uuid
-import json
 import io
 import sys
 import os
 import asyncio
+import time
 import google.generativeai as genai
 from dotenv import load_dotenv
 
 from firebase_utils import (
     initialize_firebase, save_analysis_json, save_conversation_turn, 
-    get_conversation_history, get_user_status, update_user_status
+    get_conversation_history, get_user_status, update_user_status, get_user_profile
 )
 from google.genai import types
 from google.adk.sessions import InMemorySessionService
 from google.adk.runners import Runner
-from multi_tool_agent.agent import root_agent
+from multi_tool_agent.agent import root_agent, get_agent, prompt_cache
+from multi_tool_agent.prompt_cache import PROMPT_FILES, prompt_file_for_status, load_prompt_parts
+from multi_tool_agent.model_tiers import (
+    classify_intent, select_tier, model_for_tier, next_tier, meets_response_contract, tier_stats
+)
+from shared_state import get_shared_state
+import request_trace
+from request_trace import stage, traced_call
+from util import parse_ai_response
+from wire_format import dumps_json_text
 
 # .env 파일 로드
 load_dotenv(dotenv_path="multi_tool_agent/.env")
 
+# 세션 상태를 공유 저장소에 보관하는 시간(초)
+SESSION_STATE_TTL = 60 * 60 * 24
+# 워밍업으로 미리 만들어 둔 세션을 메시지가 오지 않으면 버리기까지의 시간(초)
+WARMUP_SESSION_TTL = 120
+
 # 기본 설정
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 genai.configure(api_key=os.getenv("GOOGLE_AI_API_KEY"))
 
-def _load_prompt_for_status(status: str) -> str:
-    """사용자 상태에 따라 적절한 프롬프트 파일의 내용을 읽어 반환합니다."""
-    prompt_files = {
-        "NEEDS_ANALYSIS": "prompts/analytics_prompt.txt",
-        "AWAITING_SURVEY_RESPONSE": "prompts/analytics_prompt.txt",
-        "ROUTINE_IN_PROGRESS": "prompts/routine_feedback_prompt.txt",
-        "GOAL_ACHIEVED": "prompts/new_goal_prompt.txt"
-    }
-    filepath = prompt_files.get(status, "prompts/analytics_prompt.txt")
-    
+def _load_prompt_for_status(status: str) -> tuple[str, str]:
+    """사용자 상태에 따라 적절한 프롬프트 파일을 (파일 경로, 사용자별 데이터 템플릿)으로 반환합니다."""
+    filepath = prompt_file_for_status(status)
     print(f"🤖 상태 '{status}'에 따라 '{filepath}' 프롬프트를 로드합니다.")
-    try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            return f.read()
-    except FileNotFoundError:
-        print(f"🚨 오류: 프롬프트 파일 '{filepath}'을(를) 찾을 수 없습니다.")
-        try:
-            with open("prompts/analytics_prompt.txt", "r", encoding="utf-8") as f:
-                return f.read()
-        except FileNotFoundError:
-            return "Analyze health data."
+    _, dynamic_template = load_prompt_parts(filepath)
+    return filepath, dynamic_template
 
 class ConversationManager:
-    def __init__(self, agent):
+    def __init__(self, agent, db=None):
         self.agent = agent
-        self.db = initialize_firebase()
+        # db를 직접 넘기면 Firebase를 초기화하지 않습니다. (기록된 요청을 오프라인으로 재실행할 때 사용)
+        self.db = db if db is not None else initialize_firebase()
         ## [수정] 초기화 시 runner와 session_service를 생성하지 않습니다.
+        # (사용자, 세션)별 진행 중인 워밍업 작업과, 워밍업으로 미리 만들어 둔 (만료 시각, 세션 서비스, 사용자 상태)
+        self._warmup_tasks: dict[tuple[str, str], asyncio.Task] = {}
+        self._prepared_sessions: dict[tuple[str, str], tuple[float, InMemorySessionService, str]] = {}
         
     async def initialize(self):
-        # [수정] 이 함수는 이제 시작 메시지를 출력하는 역할만 합니다.
+        # 상태별 기본 등급 모델에 대해 정적 지시문 프롬프트 캐시를 미리 만들어 둡니다.
+        models = sorted({model_for_tier(select_tier(status, "general")) for status in PROMPT_FILES})
+        await prompt_cache.start(models)
         print("🤖 Wellness Coach AI가 초기화 준비되었습니다.")
 
-    async def send_message_for_api(self, query: str, health_data: dict | None, user_id: str, session_id: str) -> str:
-        """API 요청을 처리하고 AI의 최종 응답 텍스트를 반환하는 전용 함수"""
-        
-        ## [핵심 수정] 요청마다 세션 서비스와 Runner를 새로 생성합니다.
-        print(f"🚀 요청 ID '{session_id}'에 대한 새 Runner를 생성합니다.")
+    async def _create_session_service(self, user_id: str, session_id: str) -> InMemorySessionService:
+        """세션 서비스를 만들고, 공유 저장소에 보관된 세션 상태를 복원하여 세션을 생성합니다."""
+        # 다른 워커/노드에서 진행된 세션이라도 이어갈 수 있도록 공유 저장소에서 세션 상태를 복원합니다.
+        # redis/firestore 저장소 조회는 블로킹 호출이므로 이벤트 루프를 막지 않도록 스레드에서 실행합니다.
+        session_state = await asyncio.to_thread(
+            traced_call, "state", "get_session_state", get_shared_state().get, f"session_state:{user_id}:{session_id}"
+        ) or {}
+        session_state["user_id"] = user_id
         session_service = InMemorySessionService()
-        await session_service.create_session(app_name="wellness_coach_app", user_id=user_id, session_id=session_id)
-        
+        await session_service.create_session(
+            app_name="wellness_coach_app", user_id=user_id, session_id=session_id, state=session_state
+        )
+        return session_service
+
+    def _take_prepared_session(self, user_id: str, session_id: str) -> tuple[InMemorySessionService | None, str | None]:
+        """
+        워밍업으로 만들어 둔 세션이 아직 유효하면 (세션 서비스, 워밍업 때 읽은 사용자 상태)를 꺼내서 반환합니다.
+        없으면 (None, None)을 반환하며, 만료된 세션은 함께 정리합니다.
+        """
+        now = time.monotonic()
+        for key in [k for k, (expires_at, _, _) in self._prepared_sessions.items() if expires_at < now]:
+            del self._prepared_sessions[key]
+        prepared = self._prepared_sessions.pop((user_id, session_id), None)
+        return (prepared[1], prepared[2]) if prepared else (None, None)
+
+    def warm_up(self, user_id: str, session_id: str) -> bool:
+        """
+        채팅 화면이 열렸을 때 호출됩니다. 사용자 상태, 대화 기록, 프로필, 프롬프트와 세션을
+        백그라운드에서 미리 준비해 첫 메시지의 지연 시간을 줄입니다.
+        같은 (사용자, 세션)의 워밍업이 이미 진행 중이면 새로 시작하지 않고 False를 반환합니다.
+        """
+        key = (user_id, session_id)
+        running = self._warmup_tasks.get(key)
+        if running and not running.done():
+            return False
+        task = asyncio.create_task(self._warm_up(user_id, session_id))
+        self._warmup_tasks[key] = task
+        task.add_done_callback(lambda _: self._warmup_tasks.pop(key, None))
+        return True
+
+    async def _warm_up(self, user_id: str, session_id: str):
+        started = time.perf_counter()
+        try:
+            # Firestore 조회는 블로킹 호출이므로 스레드에서 동시에 실행합니다. 결과는 공유 캐시에 채워집니다.
+            user_status, _, _ = await asyncio.gather(
+                asyncio.to_thread(get_user_status, self.db, user_id),
+                asyncio.to_thread(get_conversation_history, self.db, user_id),
+                asyncio.to_thread(get_user_profile, self.db, user_id),
+            )
+            _load_prompt_for_status(user_status)
+            session_service = await self._create_session_service(user_id, session_id)
+            # 메모리 백엔드에서는 상태가 캐시되지 않으므로, 읽은 상태를 세션과 함께 보관해 첫 메시지에서 다시 읽지 않도록 합니다.
+            self._prepared_sessions[(user_id, session_id)] = (
+                time.monotonic() + WARMUP_SESSION_TTL, session_service, user_status
+            )
+            print(f"🔥 사용자 '{user_id}' 워밍업 완료 ({time.perf_counter() - started:.2f}초)")
+        except Exception as e:
+            print(f"🚨 사용자 '{user_id}' 워밍업 중 오류 발생: {e}")
+
+    async def _run_agent(self, agent, session_service, user_id: str, session_id: str, content) -> tuple[str, int, int, list[str]]:
+        """에이전트를 한 번 실행하고 (최종 응답, 입력 토큰 수, 출력 토큰 수, 호출된 도구 이름 목록)을 반환합니다."""
         runner = Runner(
-            agent=self.agent,
+            agent=agent,
             app_name="wellness_coach_app",
             session_service=session_service
         )
-        
-        # 1. 사용자의 현재 대화 상태 조회
-        user_status = get_user_status(self.db, user_id)
-        
-        # 2. 상태에 맞는 프롬프트 동적 로드
-        prompt_template = _load_prompt_for_status(user_status)
-        
-        # 3. 프롬프트에 데이터 주입 (기존 로직과 동일)
-        final_prompt = prompt_template
-        if health_data:
-            final_prompt = final_prompt.replace("((USER_PROFILE))", json.dumps(health_data.get("user_profile", {}), ensure_ascii=False))
-            final_prompt = final_prompt.replace("((CURRENT_HEALTH_DATA))", json.dumps(health_data, ensure_ascii=False))
-            # ... (다른 데이터 placeholder들도 필요 시 추가) ...
-        
-        history_list = get_conversation_history(db=self.db, user_id=user_id)
-        history_str = "\n".join(history_list)
-        final_prompt = final_prompt.replace("((CONVERSATION_HISTORY))", history_str)
-        final_prompt = final_prompt.replace("((USER_GOAL))", query)
-        
-        full_query = f"{final_prompt}\n\nLatest User Query: {query}"
-        content = types.Content(role='user', parts=[types.Part(text=full_query)])
-        
         final_response_text = "죄송합니다, 답변을 생성하는 데 실패했습니다."
-        # [수정] 새로 만든 runner를 사용합니다.
+        prompt_tokens, output_tokens, called_tools = 0, 0, []
         async for event in runner.run_async(user_id=user_id, session_id=session_id, new_message=content):
+            usage = getattr(event, "usage_metadata", None)
+            if usage:
+                prompt_tokens += usage.prompt_token_count or 0
+                output_tokens += usage.candidates_token_count or 0
+            called_tools.extend(call.name for call in event.get_function_calls())
             if event.is_final_response():
                 final_response_text = event.content.parts[0].text
                 break
+        return final_response_text, prompt_tokens, output_tokens, called_tools
+
+    async def send_message_for_api(self, query: str, health_data: dict | None, user_id: str, session_id: str,
+                                   health_data_json: str | None = None, record_trace: bool = False,
+                                   save_turn: bool = True) -> str:
+        """
+        API 요청을 처리하고 AI의 최종 응답 텍스트를 반환하는 전용 함수
+        health_data_json이 주어지면 건강 데이터를 다시 직렬화하지 않고 그대로 사용합니다.
+        record_trace가 True이면(또는 REQUEST_TRACE=1) 요청을 traces/에 기록하여 replay_trace.py로 재실행할 수 있게 합니다.
+        save_turn이 False이면 대화 기록에 남기지 않습니다. (선제적 분석 스케줄러처럼 사용자가 보낸 메시지가 아닌 경우)
+        """
+        if not (record_trace or request_trace.TRACE_ALL_REQUESTS) or request_trace.current_trace() is not None:
+            return await self._send_message(query, health_data, user_id, session_id, health_data_json, save_turn)
+
+        trace = request_trace.start_recording({
+            "query": query, "health_data": health_data, "user_id": user_id,
+            "session_id": session_id, "health_data_json": health_data_json, "save_turn": save_turn
+        })
+        try:
+            trace.output = await self._send_message(query, health_data, user_id, session_id, health_data_json, save_turn)
+            return trace.output
+        finally:
+            try:
+                request_trace.finish_recording(trace)
+            except OSError as e:
+                print(f"🚨 요청 기록 저장 중 오류 발생: {e}")
+
+    async def _send_message(self, query: str, health_data: dict | None, user_id: str, session_id: str,
+                            health_data_json: str | None = None, save_turn: bool = True) -> str:
+        ## [핵심 수정] 요청마다 세션 서비스와 Runner를 새로 생성합니다.
+        print(f"🚀 요청 ID '{session_id}'에 대한 새 Runner를 생성합니다.")
+        session_state_key = f"session_state:{user_id}:{session_id}"
+        with stage("prepare_session"):
+            warmup = self._warmup_tasks.get((user_id, session_id))
+            if warmup and not warmup.done():
+                # 워밍업이 끝나기 전에 메시지가 오면 워밍업을 기다려 그 세션을 사용합니다.
+                # (따로 세션을 만들면 뒤늦게 준비된 워밍업 세션이 이번 대화의 상태 변경보다 오래된 상태로 남기 때문)
+                await asyncio.shield(warmup)
+            session_service, warmed_status = self._take_prepared_session(user_id, session_id)
+            if session_service is None:
+                session_service = await self._create_session_service(user_id, session_id)
         
-        save_conversation_turn(
-            db=self.db, user_id=user_id,
-            session_id=session_id,
-            user_query=query, ai_response=final_response_text
-        )
+        # 1. 사용자의 현재 대화 상태 조회
+        with stage("load_user_status"):
+            # 워밍업 때 읽은 상태가 있으면 그대로 사용합니다. (재실행할 수 있도록 같은 호출로 기록)
+            load_status = (lambda db, uid: warmed_status) if warmed_status else get_user_status
+            user_status = traced_call("firestore", "get_user_status", load_status, self.db, user_id)
+        
+        with stage("build_prompt"):
+            # 2. 상태에 맞는 프롬프트 동적 로드
+            # 정적 지시문은 에이전트 instruction(프롬프트 캐시)으로 전달되므로, 메시지에는 사용자별 데이터 부분만 담습니다.
+            prompt_file, prompt_template = _load_prompt_for_status(user_status)
+            
+            # 3. 프롬프트에 데이터 주입 (기존 로직과 동일)
+            final_prompt = prompt_template
+            if health_data:
+                final_prompt = final_prompt.replace("((USER_PROFILE))", dumps_json_text(health_data.get("user_profile", {})))
+                if health_data_json is None:
+                    health_data_json = dumps_json_text(health_data)
+                final_prompt = final_prompt.replace("((CURRENT_HEALTH_DATA))", health_data_json)
+                # ... (다른 데이터 placeholder들도 필요 시 추가) ...
+            
+            history_list = traced_call(
+                "firestore", "get_conversation_history", get_conversation_history, db=self.db, user_id=user_id
+            )
+            history_str = "\n".join(history_list)
+            final_prompt = final_prompt.replace("((CONVERSATION_HISTORY))", history_str)
+            final_prompt = final_prompt.replace("((USER_GOAL))", query)
+            
+            full_query = f"{final_prompt}\n\nLatest User Query: {query}"
+            content = types.Content(role='user', parts=[types.Part(text=full_query)])
         
-        if user_status == 'NEEDS_ANALYSIS' and "analysis_json" in final_response_text:
-             update_user_status(self.db, user_id, "ROUTINE_IN_PROGRESS")
+        # 4. 상태와 의도에 맞는 모델 등급으로 실행하고, 응답 형식이 어긋나면 상위 등급으로 다시 실행합니다.
+        intent = classify_intent(query)
+        tier = select_tier(user_status, intent)
+        while True:
+            model = model_for_tier(tier)
+            print(f"🧠 상태 '{user_status}', 의도 '{intent}' → '{tier}' 등급 모델 '{model}'로 응답을 생성합니다.")
+            started = time.perf_counter()
+            agent = get_agent(model, prompt_file)
+            with stage(f"run_agent:{tier}"):
+                final_response_text, prompt_tokens, output_tokens, called_tools = await self._run_agent(
+                    agent, session_service, user_id, session_id, content
+                )
+            contract_ok = meets_response_contract(final_response_text, user_status, intent)
+            escalate_to = None if contract_ok else next_tier(tier)
+            # 일정 등록처럼 부작용이 있는 도구가 이미 실행되었다면, 중복 실행을 막기 위해 다시 실행하지 않습니다.
+            if escalate_to and any(name.startswith("google_calendar_") for name in called_tools):
+                escalate_to = None
+            tier_stats.record(tier, model, time.perf_counter() - started, prompt_tokens, output_tokens,
+                              contract_ok, escalated=escalate_to is not None)
+            if escalate_to is None:
+                break
+            print(f"⬆️ 응답 형식 검사에 실패하여 '{tier}' → '{escalate_to}' 등급으로 다시 생성합니다.")
+            tier = escalate_to
+            session_service = await self._create_session_service(user_id, session_id)
+
+        with stage("persist"):
+            # 이번 대화 이전 상태로 준비된 세션이 남아 있다면 다음 메시지에서 사용하지 않도록 버립니다.
+            self._prepared_sessions.pop((user_id, session_id), None)
+            session = await session_service.get_session(
+                app_name="wellness_coach_app", user_id=user_id, session_id=session_id
+            )
+            if session:
+                await asyncio.to_thread(traced_call, "state", "set_session_state", get_shared_state().set,
+                                        session_state_key, dict(session.state), SESSION_STATE_TTL)
+
+            if save_turn:
+                traced_call(
+                    "firestore", "save_conversation_turn", save_conversation_turn,
+                    db=self.db, user_id=user_id,
+                    session_id=session_id,
+                    user_query=query, ai_response=final_response_text
+                )
+            
+            if "analysis_json" in final_response_text:
+                # 구조화된 분석 결과는 수치 지표와 함께 분석 기록에 저장하여 이후 추이 조회에 사용합니다.
+                response_data = parse_ai_response(final_response_text)
+                if response_data and "analysis_json" in response_data:
+                    traced_call("firestore", "save_analysis_json", save_analysis_json,
+                                self.db, user_id, session_id, response_data, health_data)
+
+            if user_status == 'NEEDS_ANALYSIS' and "analysis_json" in final_response_text:
+                 traced_call("firestore", "update_user_status", update_user_status, self.db, user_id, "ROUTINE_IN_PROGRESS")
 
-        return final_response_text
\ No newline at end of file
+        return final_response_text
@@ -4,24 +4,34 @@ import google.generativeai as genai
 import os
 
 # 같은 폴더에 있는 tools.py에서 모든 도구들을 가져옵니다.
-from .tools import get_health_data, Youtube, google_calendar_create_single_event, google_calendar_create_recurring_event, get_weather, find_nearby_places, search_naver_news, ask_knowledge_base, convert_natural_time_to_iso
+from .tools import get_health_data, Youtube, google_calendar_create_single_event, google_calendar_create_recurring_event, get_weather, find_nearby_places, search_naver_news, ask_knowledge_base, convert_natural_time_to_iso, get_health_trend
+from .tool_executor import ParallelToolExecutor
+from .prompt_cache import PromptCacheManager, DEFAULT_PROMPT_FILE, load_prompt_parts, prefix_hash
+import request_trace
+from proactive_scheduler import throttle_model_call
 
 # --- Prompt ---
-try:
-    with open("prompts/analytics_prompt.txt", "r", encoding="utf-8") as f:
-        HEALTHCARE_ANALYTICS_INSTRUCTIONS = f.read()
-except FileNotFoundError:
-    HEALTHCARE_ANALYTICS_INSTRUCTIONS = "Analyze health data."
+# 에이전트의 instruction에는 프롬프트의 정적 지시문 부분만 넣고, 사용자별 데이터는 매 요청 메시지로 전달합니다.
+HEALTHCARE_ANALYTICS_INSTRUCTIONS, _ = load_prompt_parts(DEFAULT_PROMPT_FILE)
+
+
+# --- 도구 실행 계층 ---
+# 같은 단계에서 호출된 독립적인 도구들을 동시에 실행하고, 도구별 제한 시간을 적용합니다.
+tool_executor = ParallelToolExecutor(
+    max_workers=int(os.getenv("AGENT_TOOL_WORKERS", "8")),
+    default_timeout=float(os.getenv("AGENT_TOOL_TIMEOUT_SECONDS", "20")),
+    timeouts={"ask_knowledge_base": 60.0},
+    side_effect_tools={"google_calendar_create_single_event", "google_calendar_create_recurring_event"}
+)
 
 
 # --- '만능' 웰니스 코치 에이전트 ---
-root_agent = Agent(
-    name="WellnessCoachAgent",
-    model="gemini-2.0-flash",
-    description="A comprehensive AI wellness coach that analyzes health data, suggests routines, and finds nearby places.",
-    instruction=HEALTHCARE_ANALYTICS_INSTRUCTIONS,  # instruction에 읽어온 프롬프트를 직접 전달
-    # ⭐ 모든 도구를 이 하나의 에이전트에게 줍니다.
-    tools=[
+DEFAULT_MODEL = "gemini-2.0-flash"
+AGENT_NAME = "WellnessCoachAgent"
+AGENT_DESCRIPTION = "A comprehensive AI wellness coach that analyzes health data, suggests routines, and finds nearby places."
+
+AGENT_TOOLS = [
+    tool_executor.wrap(request_trace.traced_tool(tool)) for tool in [
         get_health_data,
         Youtube,
         google_calendar_create_single_event,  # 단일 이벤트 도구 추가
@@ -30,6 +40,54 @@ root_agent = Agent(
         find_nearby_places,  # find_nearby_places를 여기에 포함
         ask_knowledge_base,
         convert_natural_time_to_iso,
-        search_naver_news
-    ],
+        search_naver_news,
+        get_health_trend
+    ]
+]
+
+
+# --- 프롬프트 캐시 ---
+# 상태별 정적 지시문과 도구 선언을 모델 컨텍스트 캐시로 등록하여, 매 요청마다 다시 처리하지 않도록 합니다.
+# ADK가 지시문 뒤에 덧붙이는 정체성 문장도 캐시에 넣기 위해 에이전트 이름과 설명을 함께 전달합니다.
+prompt_cache = PromptCacheManager(
+    tools=AGENT_TOOLS,
+    agent_name=AGENT_NAME,
+    agent_description=AGENT_DESCRIPTION,
+    ttl_seconds=int(os.getenv("PROMPT_CACHE_TTL_SECONDS", "3600"))
 )
+
+
+def _build_agent(model: str, prompt_file: str) -> Agent:
+    instruction, _ = load_prompt_parts(prompt_file)
+    return Agent(
+        name=AGENT_NAME,
+        model=model,
+        description=AGENT_DESCRIPTION,
+        instruction=instruction,  # instruction에 읽어온 프롬프트의 정적 지시문을 직접 전달
+        # ⭐ 모든 도구를 이 하나의 에이전트에게 줍니다.
+        tools=AGENT_TOOLS,
+        # 요청 기록/재실행 콜백이 먼저 실행됩니다. 재실행 중에는 기록된 응답을 돌려주어 모델을 호출하지 않습니다.
+        # 선제적 분석 스케줄러가 실행한 요청이면 모델 호출마다 속도 제한 토큰을 사용합니다.
+        before_model_callback=[
+            request_trace.before_model,
+            throttle_model_call,
+            prompt_cache.callback_for(prompt_file, prefix_hash(instruction))
+        ],
+        after_model_callback=[request_trace.after_model, tool_executor.prefetch_calls],
+    )
+
+
+root_agent = _build_agent(DEFAULT_MODEL, DEFAULT_PROMPT_FILE)
+_agents = {(DEFAULT_MODEL, DEFAULT_PROMPT_FILE, prefix_hash(HEALTHCARE_ANALYTICS_INSTRUCTIONS)): root_agent}
+
+
+def get_agent(model: str, prompt_file: str = DEFAULT_PROMPT_FILE) -> Agent:
+    """
+    모델 등급과 상태별 프롬프트에 맞는 같은 구성의 에이전트를 반환합니다.
+    (모델, 프롬프트, 프롬프트 내용) 조합마다 한 번만 생성하므로 프롬프트 파일이 바뀌면 새 에이전트를 만듭니다.
+    """
+    instruction, _ = load_prompt_parts(prompt_file)
+    key = (model, prompt_file, prefix_hash(instruction))
+    if key not in _agents:
+        _agents[key] = _build_agent(model, prompt_file)
+    return _agents[key]
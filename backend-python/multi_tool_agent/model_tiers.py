@@ -0,0 +1,174 @@
+# multi_tool_agent/model_tiers.py
+
+import json
+import os
+import threading
+from collections import defaultdict
+
+from util import parse_ai_response
+
+# --- 기본 모델 등급 설정 ---
+# MODEL_TIER_CONFIG 환경 변수에 JSON 파일 경로를 지정하면 아래 값들을 덮어쓸 수 있습니다.
+DEFAULT_CONFIG = {
+    # 등급별 모델 이름
+    "tiers": {
+        "light": "gemini-2.0-flash-lite",
+        "standard": "gemini-2.0-flash",
+        "strong": "gemini-2.5-pro"
+    },
+    # 응답 형식 검사에 실패했을 때 올라가는 등급 순서
+    "escalation": ["light", "standard", "strong"],
+    # 사용자 상태별 기본 등급
+    "status": {
+        "NEEDS_ANALYSIS": "standard",
+        "AWAITING_SURVEY_RESPONSE": "standard",
+        "ROUTINE_IN_PROGRESS": "light",
+        "GOAL_ACHIEVED": "light"
+    },
+    # 의도별 등급 (지정된 의도는 상태별 등급보다 우선합니다)
+    "intent": {
+        "analysis": "standard",
+        "tool": "standard",
+        "chitchat": "light"
+    },
+    # 모델별 100만 토큰당 가격(USD) [입력, 출력] - 비용 추정용
+    "prices": {
+        "gemini-2.0-flash-lite": [0.075, 0.30],
+        "gemini-2.0-flash": [0.10, 0.40],
+        "gemini-2.5-pro": [1.25, 10.00]
+    }
+}
+
+DEFAULT_TIER = "standard"
+
+# 의도 분류에 사용하는 키워드
+ANALYSIS_KEYWORDS = ["분석", "데이터 어때", "리포트"]
+TOOL_KEYWORDS = ["캘린더", "일정", "등록", "유튜브", "영상", "날씨", "주변", "공원", "장소", "뉴스", "찾아"]
+# JSON 응답 형식이 반드시 지켜져야 하는 상태 (프롬프트가 항상 JSON 출력을 요구함)
+JSON_ONLY_STATUSES = {"ROUTINE_IN_PROGRESS", "GOAL_ACHIEVED"}
+# 첫 대화에서 전체 분석(analysis_json)을 요구하는 상태. 의도와 관계없이 상태별 등급보다 낮은 모델로 내려가지 않습니다.
+ANALYSIS_STATUSES = {"NEEDS_ANALYSIS", "AWAITING_SURVEY_RESPONSE"}
+
+
+def _load_config() -> dict:
+    config = {key: dict(value) if isinstance(value, dict) else list(value) for key, value in DEFAULT_CONFIG.items()}
+    config_path = os.getenv("MODEL_TIER_CONFIG")
+    if config_path:
+        try:
+            with open(config_path, "r", encoding="utf-8") as f:
+                overrides = json.load(f)
+            for key, value in overrides.items():
+                if isinstance(value, dict) and isinstance(config.get(key), dict):
+                    config[key].update(value)
+                else:
+                    config[key] = value
+            print(f"⚙️ '{config_path}'에서 모델 등급 설정을 불러왔습니다.")
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"🚨 모델 등급 설정 파일을 읽지 못해 기본값을 사용합니다: {e}")
+    return config
+
+
+TIER_CONFIG = _load_config()
+
+
+def classify_intent(query: str) -> str:
+    """사용자 메시지를 analysis / tool / chitchat / general 중 하나의 의도로 분류합니다."""
+    if any(keyword in query for keyword in ANALYSIS_KEYWORDS):
+        return "analysis"
+    if any(keyword in query for keyword in TOOL_KEYWORDS):
+        return "tool"
+    if len(query.strip()) <= 20:
+        return "chitchat"
+    return "general"
+
+
+def select_tier(status: str, intent: str) -> str:
+    """
+    사용자 상태와 의도에 맞는 모델 등급을 선택합니다.
+    지정된 의도 등급이 상태별 등급보다 우선하지만, 분석이 필요한 상태에서는 둘 중 높은 등급을 사용합니다.
+    """
+    status_tier = TIER_CONFIG["status"].get(status, DEFAULT_TIER)
+    tier = TIER_CONFIG["intent"].get(intent) or status_tier
+    if status in ANALYSIS_STATUSES:
+        tier = max(tier, status_tier, key=_tier_rank)
+    return tier if tier in TIER_CONFIG["tiers"] else DEFAULT_TIER
+
+
+def _tier_rank(tier: str) -> int:
+    order = TIER_CONFIG["escalation"]
+    return order.index(tier) if tier in order else -1
+
+
+def model_for_tier(tier: str) -> str:
+    return TIER_CONFIG["tiers"][tier]
+
+
+def next_tier(tier: str) -> str | None:
+    """응답 형식 검사 실패 시 올라갈 다음 등급을 반환합니다. 이미 최상위 등급이면 None을 반환합니다."""
+    order = TIER_CONFIG["escalation"]
+    if tier not in order:
+        return None
+    index = order.index(tier)
+    return order[index + 1] if index + 1 < len(order) else None
+
+
+def meets_response_contract(response_text: str, status: str, intent: str) -> bool:
+    """
+    server.py가 파싱하는 응답 형식을 지켰는지 확인합니다.
+    - 분석 요청: "analysis_json"과 "response_for_user" 두 키를 가진 JSON
+    - 루틴 피드백/새 목표 상태: "response_for_user"를 가진 JSON
+    - 그 밖의 대화: 일반 문장이면 통과, JSON을 시도했다면 올바르게 파싱되어야 함
+    """
+    data = parse_ai_response(response_text)
+    if intent == "analysis" and status in ("NEEDS_ANALYSIS", "AWAITING_SURVEY_RESPONSE"):
+        return bool(data) and "analysis_json" in data and "response_for_user" in data
+    if status in JSON_ONLY_STATUSES:
+        return bool(data) and "response_for_user" in data
+    stripped = response_text.strip()
+    if stripped.startswith("{") or stripped.startswith("```"):
+        return bool(data) and "response_for_user" in data
+    return bool(stripped)
+
+
+class TierStats:
+    """등급/모델별 호출 횟수, 지연 시간, 토큰 사용량, 추정 비용, 승격 횟수를 집계합니다."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {
+            "calls": 0, "contract_failures": 0, "escalations": 0,
+            "total_latency_seconds": 0.0, "max_latency_seconds": 0.0,
+            "prompt_tokens": 0, "output_tokens": 0, "estimated_cost_usd": 0.0
+        })
+
+    def record(self, tier: str, model: str, latency_seconds: float, prompt_tokens: int,
+               output_tokens: int, contract_ok: bool, escalated: bool):
+        input_price, output_price = TIER_CONFIG["prices"].get(model, [0.0, 0.0])
+        cost = (prompt_tokens * input_price + output_tokens * output_price) / 1_000_000
+        with self._lock:
+            stats = self._stats[(tier, model)]
+            stats["calls"] += 1
+            stats["contract_failures"] += 0 if contract_ok else 1
+            stats["escalations"] += 1 if escalated else 0
+            stats["total_latency_seconds"] += latency_seconds
+            stats["max_latency_seconds"] = max(stats["max_latency_seconds"], latency_seconds)
+            stats["prompt_tokens"] += prompt_tokens
+            stats["output_tokens"] += output_tokens
+            stats["estimated_cost_usd"] += cost
+
+    def snapshot(self) -> list[dict]:
+        with self._lock:
+            results = []
+            for (tier, model), stats in self._stats.items():
+                calls = stats["calls"]
+                results.append({
+                    "tier": tier,
+                    "model": model,
+                    **stats,
+                    "avg_latency_seconds": round(stats["total_latency_seconds"] / calls, 3) if calls else 0.0,
+                    "estimated_cost_usd": round(stats["estimated_cost_usd"], 6)
+                })
+            return results
+
+
+tier_stats = TierStats()
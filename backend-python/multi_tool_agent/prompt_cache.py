@@ -0,0 +1,273 @@
+# multi_tool_agent/prompt_cache.py
+
+import asyncio
+import hashlib
+import os
+import threading
+import time
+
+# 사용자 상태별 프롬프트 파일
+PROMPT_FILES = {
+    "NEEDS_ANALYSIS": "prompts/analytics_prompt.txt",
+    "AWAITING_SURVEY_RESPONSE": "prompts/analytics_prompt.txt",
+    "ROUTINE_IN_PROGRESS": "prompts/routine_feedback_prompt.txt",
+    "GOAL_ACHIEVED": "prompts/new_goal_prompt.txt"
+}
+DEFAULT_PROMPT_FILE = "prompts/analytics_prompt.txt"
+
+# 다시 시도해도 성공할 수 없는 캐시 생성 오류(프롬프트가 최소 토큰 수보다 짧거나, 모델이 캐시를 지원하지 않음)의 메시지
+PERMANENT_CACHE_ERROR_HINTS = ("too small", "min_total_token_count", "not supported", "does not support", "not found")
+# 일시적인 오류(네트워크, 할당량 등)로 캐시 생성에 실패했을 때 다시 시도하기까지의 최대 대기 시간(초)
+MAX_RETRY_BACKOFF_SECONDS = 3600
+
+# 프롬프트 파일에서 이 줄 위는 모든 사용자에게 같은 정적 지시문, 아래는 사용자별 데이터가 들어가는 부분입니다.
+DYNAMIC_MARKER = "<<<DYNAMIC_USER_CONTEXT>>>"
+
+_prompt_file_cache: dict[str, tuple[float, str]] = {}
+
+
+def read_prompt_file(filepath: str) -> str:
+    """프롬프트 파일을 읽습니다. 파일이 수정되지 않았다면 메모리에 읽어둔 내용을 재사용합니다."""
+    mtime = os.path.getmtime(filepath)
+    cached = _prompt_file_cache.get(filepath)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(filepath, "r", encoding="utf-8") as f:
+        content = f.read()
+    _prompt_file_cache[filepath] = (mtime, content)
+    return content
+
+
+def prompt_file_for_status(status: str) -> str:
+    return PROMPT_FILES.get(status, DEFAULT_PROMPT_FILE)
+
+
+def split_prompt(template: str) -> tuple[str, str]:
+    """프롬프트를 (정적 지시문, 사용자별 데이터 템플릿)으로 나눕니다. 구분선이 없으면 전체를 정적 지시문으로 봅니다."""
+    static_prefix, marker, dynamic_template = template.partition(DYNAMIC_MARKER)
+    if not marker:
+        return template.strip(), ""
+    return static_prefix.rstrip(), dynamic_template.strip()
+
+
+def load_prompt_parts(filepath: str) -> tuple[str, str]:
+    """프롬프트 파일을 읽어 (정적 지시문, 사용자별 데이터 템플릿)을 반환합니다."""
+    try:
+        return split_prompt(read_prompt_file(filepath))
+    except FileNotFoundError:
+        print(f"🚨 오류: 프롬프트 파일 '{filepath}'을(를) 찾을 수 없습니다.")
+        try:
+            return split_prompt(read_prompt_file(DEFAULT_PROMPT_FILE))
+        except FileNotFoundError:
+            return "Analyze health data.", ""
+
+
+def prefix_hash(static_prefix: str) -> str:
+    return hashlib.sha256(static_prefix.encode("utf-8")).hexdigest()[:16]
+
+
+def adk_system_instruction(instruction: str, agent_name: str, agent_description: str = "") -> str:
+    """
+    ADK(1.9)가 요청에 넣는 것과 같은 system_instruction을 만듭니다.
+    ADK는 에이전트 instruction 뒤에 이름/설명으로 만든 정체성 문장을 덧붙이므로, 캐시에도 같은 문장을 넣어야
+    캐시를 사용한 요청과 사용하지 않은 요청이 같은 지시문으로 동작합니다.
+    (google.adk.flows.llm_flows.identity, LlmRequest.append_instructions 참고)
+    """
+    identity = [f'You are an agent. Your internal name is "{agent_name}".']
+    if agent_description:
+        identity.append(f' The description about you is "{agent_description}"')
+    return "\n\n".join([instruction, *identity]) if instruction else "\n\n".join(identity)
+
+
+def _is_permanent_cache_error(error: Exception) -> bool:
+    """google.genai의 4xx 오류 중, 같은 프롬프트와 모델로는 다시 시도해도 성공할 수 없는 오류인지 확인합니다."""
+    code = getattr(error, "code", None)
+    message = str(error).lower()
+    return code in (400, 404) and any(hint in message for hint in PERMANENT_CACHE_ERROR_HINTS)
+
+
+class PromptCacheManager:
+    """
+    상태별 정적 지시문(과 도구 선언)을 Gemini 컨텍스트 캐시로 등록하고 관리합니다.
+
+    - 서버 시작 시 캐시를 만들고, TTL이 끝나기 전에 주기적으로 연장합니다.
+    - 프롬프트 파일이 바뀌면 새 캐시를 만들고 이전 캐시를 삭제합니다.
+    - before_model_callback에서 요청에 캐시 이름을 지정하고, 캐시에 포함된 지시문/도구를 요청에서 제거하여
+      매 요청마다 사용자별 데이터 부분만 전송되도록 합니다.
+    """
+
+    def __init__(self, tools: list, agent_name: str, agent_description: str = "", ttl_seconds: int = 3600,
+                 refresh_margin_seconds: int = 600, check_interval_seconds: int = 60):
+        self.tools = tools
+        self.agent_name = agent_name
+        self.agent_description = agent_description
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.check_interval_seconds = check_interval_seconds
+        self.enabled = os.getenv("PROMPT_CACHE_ENABLED", "1") != "0"
+        self._client = None
+        self._lock = threading.Lock()
+        # (프롬프트 파일, 모델) -> {"name", "prefix_hash", "instruction_hash", "expires_at"}
+        self._entries: dict[tuple[str, str], dict] = {}
+        # 캐시를 만들 수 없는 (프롬프트 파일, 모델, prefix_hash) - 프롬프트가 바뀌기 전까지 다시 시도하지 않음
+        self._failed: set[tuple[str, str, str]] = set()
+        # 일시적인 오류로 실패한 (프롬프트 파일, 모델) -> (다음 시도 시각, 연속 실패 횟수)
+        self._retry: dict[tuple[str, str], tuple[float, int]] = {}
+        self._creating: set[tuple[str, str]] = set()
+
+    def _get_client(self):
+        if self._client is None:
+            from google import genai
+            self._client = genai.Client()
+        return self._client
+
+    def _tool_declarations(self) -> list:
+        from google.adk.tools import FunctionTool
+        return [FunctionTool(tool)._get_declaration() for tool in self.tools]
+
+    def _create(self, filepath: str, model: str):
+        """정적 지시문과 도구 선언으로 새 캐시를 만들고, 같은 키의 이전 캐시는 삭제합니다."""
+        from google.genai import types
+
+        static_prefix, _ = load_prompt_parts(filepath)
+        current_hash = prefix_hash(static_prefix)
+        if (filepath, model, current_hash) in self._failed:
+            self._retry.pop((filepath, model), None)
+            return
+        system_instruction = adk_system_instruction(static_prefix, self.agent_name, self.agent_description)
+        try:
+            cache = self._get_client().caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    display_name=f"wellness_prompt_{os.path.basename(filepath)}_{current_hash}",
+                    system_instruction=system_instruction,
+                    tools=[types.Tool(function_declarations=self._tool_declarations())],
+                    ttl=f"{self.ttl_seconds}s"
+                )
+            )
+        except Exception as e:
+            # 실패하는 동안에는 캐시 없이 전체 지시문을 전송합니다.
+            if _is_permanent_cache_error(e):
+                # 프롬프트가 캐시 최소 토큰 수보다 짧은 경우 등은 프롬프트가 바뀌기 전까지 다시 시도하지 않습니다.
+                print(f"⚠️ '{filepath}' ({model}) 프롬프트 캐시를 만들 수 없어 캐시 없이 진행합니다: {e}")
+                self._failed.add((filepath, model, current_hash))
+                self._retry.pop((filepath, model), None)
+            else:
+                _, failures = self._retry.get((filepath, model), (0.0, 0))
+                backoff = min(self.check_interval_seconds * 2 ** failures, MAX_RETRY_BACKOFF_SECONDS)
+                self._retry[(filepath, model)] = (time.time() + backoff, failures + 1)
+                print(f"⚠️ '{filepath}' ({model}) 프롬프트 캐시 생성 실패, {backoff}초 후 다시 시도합니다: {e}")
+            return
+
+        self._retry.pop((filepath, model), None)
+        with self._lock:
+            previous = self._entries.get((filepath, model))
+            self._entries[(filepath, model)] = {
+                "name": cache.name,
+                "prefix_hash": current_hash,
+                "instruction_hash": prefix_hash(system_instruction),
+                "expires_at": time.time() + self.ttl_seconds
+            }
+        print(f"✅ '{filepath}' ({model}) 프롬프트 캐시를 생성했습니다: {cache.name}")
+        if previous:
+            try:
+                self._get_client().caches.delete(name=previous["name"])
+            except Exception as e:
+                print(f"⚠️ 이전 프롬프트 캐시 삭제 실패 ({previous['name']}): {e}")
+
+    def _refresh(self, filepath: str, model: str, entry: dict):
+        """프롬프트가 바뀌었으면 캐시를 다시 만들고, TTL이 곧 끝나면 연장합니다."""
+        from google.genai import types
+
+        static_prefix, _ = load_prompt_parts(filepath)
+        if prefix_hash(static_prefix) != entry["prefix_hash"]:
+            print(f"♻️ '{filepath}' 프롬프트가 변경되어 캐시를 다시 만듭니다.")
+            self._create(filepath, model)
+            return
+        if entry["expires_at"] - time.time() > self.refresh_margin_seconds:
+            return
+        try:
+            self._get_client().caches.update(
+                name=entry["name"], config=types.UpdateCachedContentConfig(ttl=f"{self.ttl_seconds}s")
+            )
+            entry["expires_at"] = time.time() + self.ttl_seconds
+        except Exception as e:
+            # 캐시가 이미 만료되었거나 삭제된 경우 새로 만듭니다.
+            print(f"⚠️ 프롬프트 캐시 연장 실패, 새로 만듭니다 ({entry['name']}): {e}")
+            self._create(filepath, model)
+
+    async def start(self, models: list[str]):
+        """서버 시작 시 모든 상태 프롬프트 × 모델 조합의 캐시를 만들고, 주기적인 갱신 작업을 시작합니다."""
+        if not self.enabled:
+            print("ℹ️ PROMPT_CACHE_ENABLED=0 이므로 프롬프트 캐시를 사용하지 않습니다.")
+            return
+        for filepath in sorted(set(PROMPT_FILES.values())):
+            for model in models:
+                await asyncio.to_thread(self._create, filepath, model)
+        asyncio.create_task(self._refresh_loop())
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.check_interval_seconds)
+            with self._lock:
+                entries = list(self._entries.items())
+            for (filepath, model), entry in entries:
+                try:
+                    await asyncio.to_thread(self._refresh, filepath, model, entry)
+                except Exception as e:
+                    print(f"🚨 프롬프트 캐시 갱신 중 오류 발생: {e}")
+            # 일시적인 오류로 만들지 못한 캐시는 대기 시간이 지나면 다시 만듭니다.
+            now = time.time()
+            for (filepath, model), (retry_at, _) in list(self._retry.items()):
+                if retry_at <= now and (filepath, model) not in self._creating:
+                    try:
+                        await asyncio.to_thread(self._create, filepath, model)
+                    except Exception as e:
+                        print(f"🚨 프롬프트 캐시 재시도 중 오류 발생: {e}")
+
+    def _ensure_in_background(self, filepath: str, model: str):
+        """시작 시 만들지 않은 조합(예: 승격된 모델)의 캐시를 백그라운드에서 만듭니다."""
+        key = (filepath, model)
+        if key in self._creating:
+            return
+        # 일시적인 오류로 실패했다면 대기 시간이 지날 때까지 요청마다 다시 시도하지 않습니다.
+        retry = self._retry.get(key)
+        if retry and retry[0] > time.time():
+            return
+        self._creating.add(key)
+
+        async def create():
+            try:
+                await asyncio.to_thread(self._create, filepath, model)
+            finally:
+                self._creating.discard(key)
+
+        asyncio.get_running_loop().create_task(create())
+
+    def callback_for(self, filepath: str, static_hash: str):
+        """
+        특정 프롬프트로 만든 에이전트에 등록할 before_model_callback을 반환합니다.
+        캐시가 준비되어 있으면 요청이 캐시를 사용하도록 바꾸고, 없으면 요청을 그대로 둡니다.
+        """
+        def apply_prompt_cache(callback_context, llm_request):
+            if not self.enabled:
+                return None
+            model = llm_request.model
+            entry = self._entries.get((filepath, model))
+            if entry is None or entry["expires_at"] <= time.time():
+                if (filepath, model, static_hash) not in self._failed:
+                    self._ensure_in_background(filepath, model)
+                return None
+            # 에이전트가 만들어진 뒤 프롬프트가 바뀌었거나, ADK가 만든 지시문이 캐시에 넣은 지시문과 다르면
+            # (세션 상태가 주입된 경우 등) 캐시를 사용했을 때 동작이 달라지므로 사용하지 않습니다.
+            if entry["prefix_hash"] != static_hash:
+                return None
+            if prefix_hash(llm_request.config.system_instruction or "") != entry["instruction_hash"]:
+                return None
+            llm_request.config.cached_content = entry["name"]
+            llm_request.config.system_instruction = None
+            llm_request.config.tools = None
+            llm_request.config.tool_config = None
+            return None
+
+        return apply_prompt_cache
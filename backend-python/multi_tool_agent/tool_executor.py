@@ -0,0 +1,144 @@
+# multi_tool_agent/tool_executor.py
+
+import asyncio
+import contextvars
+import functools
+import inspect
+import json
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from google.adk.tools import ToolContext
+
+# 미리 시작했지만 에이전트가 가져가지 않은 결과를 버리기까지의 시간(초)
+PREFETCH_EXPIRE_SECONDS = 300
+
+
+def _args_key(args: dict) -> str:
+    return json.dumps(args, sort_keys=True, ensure_ascii=False, default=str)
+
+
+class ParallelToolExecutor:
+    """
+    한 번의 모델 응답에 포함된 여러 도구 호출을 스레드 풀에서 동시에 실행하는 실행 계층입니다.
+
+    ADK는 같은 단계의 도구 호출을 하나씩 순서대로 실행하므로, 모델 응답 직후(after_model_callback)
+    모든 호출을 미리 시작해 두고, 각 도구가 실제로 호출될 때는 이미 실행 중인 결과를 기다리기만 합니다.
+    따라서 한 단계의 실행 시간은 각 도구 시간의 합이 아니라 가장 느린 도구의 시간이 됩니다.
+    """
+
+    def __init__(self, max_workers: int = 8, default_timeout: float = 20.0, timeouts: dict[str, float] | None = None,
+                 side_effect_tools: set[str] | None = None):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="agent-tool")
+        self.default_timeout = default_timeout
+        self.timeouts = timeouts or {}
+        # 일정 등록처럼 부작용이 있는 도구는 미리 실행하지 않고 제한 시간도 적용하지 않습니다.
+        # (시간 초과로 알린 뒤 뒤늦게 실행이 끝나면 모델이 다시 호출하여 중복 등록될 수 있기 때문)
+        self.side_effect_tools = set(side_effect_tools or ())
+        self._tools: dict[str, callable] = {}
+        # (invocation_id, 도구 이름, 인자) -> 미리 시작한 (시작 시각, 작업) 목록
+        self._pending: dict[tuple[str, str, str], deque] = defaultdict(deque)
+
+    def wrap(self, func):
+        """
+        동기 도구 함수를 스레드 풀에서 실행되는 비동기 도구로 감쌉니다. (이름, 설명과 모델에 보이는 인자는 그대로 유지)
+        미리 시작한 결과를 같은 요청(invocation)에서만 가져가도록, ADK가 tool_context를 주입하게 합니다.
+        """
+        name = func.__name__
+        self._tools[name] = func
+        signature = inspect.signature(func)
+        takes_context = "tool_context" in signature.parameters
+
+        @functools.wraps(func)
+        async def wrapper(*args, tool_context: ToolContext = None, **kwargs):
+            invocation_id = getattr(tool_context, "invocation_id", None)
+            task = None if args or invocation_id is None else self._take_prefetched(invocation_id, name, kwargs)
+            if takes_context:
+                kwargs["tool_context"] = tool_context
+            if task is None:
+                task = self._start(name, func, args, kwargs)
+            return await task
+
+        if not takes_context:
+            # tool_context는 ADK가 모델에 보내는 도구 선언에서 제외하므로, 모델에 보이는 인자는 바뀌지 않습니다.
+            wrapper.__signature__ = signature.replace(parameters=[
+                *signature.parameters.values(),
+                inspect.Parameter("tool_context", inspect.Parameter.KEYWORD_ONLY, default=None, annotation=ToolContext)
+            ])
+        return wrapper
+
+    def _start(self, name: str, func, args: tuple, kwargs: dict) -> asyncio.Task:
+        """도구를 스레드 풀에서 실행하기 시작합니다."""
+        loop = asyncio.get_running_loop()
+        running = loop.create_future()
+
+        def run():
+            loop.call_soon_threadsafe(lambda: running.done() or running.set_result(None))
+            return func(*args, **kwargs)
+
+        # run_in_executor는 컨텍스트 변수를 전달하지 않으므로, 요청 기록(request_trace) 등이 스레드에서도 보이도록 복사합니다.
+        context = contextvars.copy_context()
+        future = loop.run_in_executor(self._pool, functools.partial(context.run, run))
+        return asyncio.ensure_future(self._await_result(name, future, running))
+
+    async def _await_result(self, name: str, future: asyncio.Future, running: asyncio.Future):
+        timeout = None if name in self.side_effect_tools else self.timeouts.get(name, self.default_timeout)
+        try:
+            # 제한 시간은 스레드 풀에서 대기한 시간을 빼고, 도구가 실제로 실행되기 시작한 시점부터 계산합니다.
+            await asyncio.wait({future, running}, return_when=asyncio.FIRST_COMPLETED)
+            return await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            print(f"⏱️ 도구 '{name}' 실행이 {timeout}초를 초과하여 중단했습니다.")
+            return f"'{name}' 도구 실행 시간이 초과되었습니다. 다른 방법으로 답변해주세요."
+        except Exception as e:
+            # 한 도구가 실패해도 같은 단계의 다른 도구 결과는 그대로 사용할 수 있도록 오류를 결과로 돌려줍니다.
+            print(f"❌ 도구 '{name}' 실행 중 오류 발생: {e}")
+            return f"'{name}' 도구 실행 중 오류가 발생했습니다: {e}"
+        finally:
+            if not running.done():
+                running.cancel()
+
+    def _take_prefetched(self, invocation_id: str, name: str, kwargs: dict) -> asyncio.Task | None:
+        entries = self._pending.get((invocation_id, name, _args_key(kwargs)))
+        if not entries:
+            return None
+        _, task = entries.popleft()
+        return task
+
+    def _expire_stale(self):
+        now = time.monotonic()
+        for key in list(self._pending):
+            entries = self._pending[key]
+            while entries and now - entries[0][0] > PREFETCH_EXPIRE_SECONDS:
+                entries.popleft()
+            if not entries:
+                del self._pending[key]
+
+    def prefetch_calls(self, callback_context, llm_response):
+        """
+        after_model_callback로 등록됩니다. 모델 응답에 도구 호출이 2개 이상이면 모두 동시에 실행을 시작합니다.
+        응답 자체는 수정하지 않으므로 None을 반환합니다.
+        """
+        content = getattr(llm_response, "content", None)
+        if not content or not content.parts:
+            return None
+        calls = [part.function_call for part in content.parts if part.function_call]
+        if len(calls) < 2:
+            return None
+
+        self._expire_stale()
+        started = 0
+        for call in calls:
+            func = self._tools.get(call.name)
+            # tool_context가 필요한 도구는 ADK가 직접 주입해야 하고, 부작용이 있는 도구는 모델이 실제로 호출할 때만 실행합니다.
+            if (func is None or call.name in self.side_effect_tools
+                    or "tool_context" in inspect.signature(func).parameters):
+                continue
+            args = dict(call.args or {})
+            task = self._start(call.name, func, (), args)
+            self._pending[(callback_context.invocation_id, call.name, _args_key(args))].append((time.monotonic(), task))
+            started += 1
+        if started:
+            print(f"⚡ {started}개의 도구 호출을 병렬로 실행합니다: {[call.name for call in calls]}")
+        return None
@@ -9,20 +9,33 @@ from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from firebase_utils import initialize_firebase, get_user_profile
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
+from firebase_utils import initialize_firebase, get_user_profile, get_metric_rollups
+from util import HEALTH_METRICS, summarize_metric_trend
+from google.adk.tools import ToolContext
 from googleapiclient.errors import HttpError
 from typing import Optional
 from google.generativeai.caching import CachedContent
 import google.generativeai as genai
 from firebase_admin import firestore
 import dateparser
-from typing import Optional
+import hashlib
+from shared_state import get_shared_state
 
 # 구글 캘린더 API가 허용할 권한 범위
 SCOPES = ["https://www.googleapis.com/auth/calendar.events"]
 
 KNOWLEDGE_CACHE = None
 
+# 공유 캐시에 도구 결과를 보관하는 시간(초)
+WEATHER_CACHE_TTL = 60 * 10
+KNOWLEDGE_ANSWER_CACHE_TTL = 60 * 60 * 24
+
+# 외부 API 호출 제한 시간(초). 응답이 없는 호출이 도구 실행 스레드를 계속 점유하지 않도록 합니다.
+HTTP_TIMEOUT_SECONDS = float(os.getenv("TOOL_HTTP_TIMEOUT_SECONDS", "10"))
+KNOWLEDGE_REQUEST_TIMEOUT_SECONDS = 55
+
 
 def _initialize_cache_if_needed():
     """
@@ -88,7 +101,7 @@ def Youtube(query: str) -> str:
         return "YouTube API 키가 설정되지 않았습니다."
 
     try:
-        youtube_service = build('youtube', 'v3', developerKey=api_key)
+        youtube_service = build('youtube', 'v3', developerKey=api_key, http=httplib2.Http(timeout=HTTP_TIMEOUT_SECONDS))
 
         request = youtube_service.search().list(
             q=query,
@@ -222,7 +235,7 @@ def google_calendar_create_single_event(title: str, start_time: str, end_time: s
         return "Google Calendar 인증에 실패했습니다."
 
     try:
-        service = build("calendar", "v3", credentials=creds)
+        service = build("calendar", "v3", http=AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT_SECONDS)))
         event_body = {
             "summary": title,
             "description": "WellnessCoachAI를 통해 생성된 일정입니다.",
@@ -254,7 +267,7 @@ def google_calendar_create_recurring_event(title: str, start_time: str, end_time
         return "Google Calendar 인증에 실패했습니다."
 
     try:
-        service = build("calendar", "v3", credentials=creds)
+        service = build("calendar", "v3", http=AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT_SECONDS)))
         event_body = {
             "summary": title,
             "description": "WellnessCoachAI를 통해 생성된 일정입니다.",
@@ -278,11 +291,16 @@ def get_weather(location: str) -> str:
     if not api_key:
         return "OpenWeatherMap API 키가 설정되지 않았습니다."
 
+    cache_key = f"tool:get_weather:{location}"
+    cached = get_shared_state().get(cache_key)
+    if cached:
+        return cached
+
     # OpenWeatherMap API URL
     url = f"https://api.openweathermap.org/data/2.5/weather?q={location}&appid={api_key}&lang=kr&units=metric"
 
     try:
-        response = requests.get(url)
+        response = requests.get(url, timeout=HTTP_TIMEOUT_SECONDS)
         response.raise_for_status()
         data = response.json()
 
@@ -290,7 +308,9 @@ def get_weather(location: str) -> str:
         temp = data['main']['temp']
         feels_like = data['main']['feels_like']
 
-        return f"현재 {location}의 날씨는 '{description}'이며, 온도는 {temp}°C, 체감 온도는 {feels_like}°C 입니다."
+        result = f"현재 {location}의 날씨는 '{description}'이며, 온도는 {temp}°C, 체감 온도는 {feels_like}°C 입니다."
+        get_shared_state().set(cache_key, result, WEATHER_CACHE_TTL)
+        return result
 
     except Exception as e:
         return f"{location}의 날씨 정보를 가져오는 데 실패했습니다: {e}"
@@ -322,7 +342,7 @@ def search_naver_news(query: str) -> str:
     }
 
     try:
-        response = requests.get(url, headers=headers, params=params)
+        response = requests.get(url, headers=headers, params=params, timeout=HTTP_TIMEOUT_SECONDS)
         response.raise_for_status()
         data = response.json()
 
@@ -373,7 +393,7 @@ def find_nearby_places(query: str) -> str:
     }
 
     try:
-        response = requests.get(url, headers=headers, params=params)
+        response = requests.get(url, headers=headers, params=params, timeout=HTTP_TIMEOUT_SECONDS)
         response.raise_for_status()
 
         data = response.json()
@@ -406,6 +426,12 @@ def ask_knowledge_base(question: str) -> str:
     분석 중 과학적 근거를 찾을 때 사용합니다.
     """
     print(f"TOOL CALLED: ask_knowledge_base(question='{question}')")
+    # 같은 질문에 대한 답변은 모든 워커가 공유 캐시에서 재사용합니다.
+    cache_key = "tool:ask_knowledge_base:" + hashlib.sha256(question.encode("utf-8")).hexdigest()
+    cached = get_shared_state().get(cache_key)
+    if cached:
+        return cached
+
     try:
         # 함수가 호출될 때 캐시가 로드되었는지 확인하고, 안됐으면 로드합니다.
         _initialize_cache_if_needed()
@@ -414,8 +440,35 @@ def ask_knowledge_base(question: str) -> str:
         model = genai.GenerativeModel.from_cached_content(
             cached_content=KNOWLEDGE_CACHE)
 
-        response = model.generate_content(question)
+        response = model.generate_content(question, request_options={"timeout": KNOWLEDGE_REQUEST_TIMEOUT_SECONDS})
 
+        get_shared_state().set(cache_key, response.text, KNOWLEDGE_ANSWER_CACHE_TTL)
         return response.text
     except Exception as e:
         return f"지식 베이스 조회 중 오류가 발생했습니다: {e}"
+
+
+def get_health_trend(metric: str, weeks: int, tool_context: ToolContext) -> str:
+    """
+    Look up how one of the user's health metrics changed over the last few weeks, using weekly averages of past analyses.
+    Use this to cite concrete trends in routine feedback (e.g. "deep sleep over the last 4 weeks").
+    Args:
+        metric (str): One of sleep_duration_minutes, deep_sleep_minutes, rem_sleep_minutes, light_sleep_minutes,
+            awake_minutes, total_steps, exercise_minutes, calories_burned, avg_heart_rate, max_heart_rate,
+            avg_stress, calorie_intake, hydration_liters, avg_systolic, avg_diastolic, min_oxygen_saturation.
+        weeks (int): Number of recent weeks to include (1-12).
+    """
+    print(f"TOOL CALLED: get_health_trend(metric='{metric}', weeks={weeks})")
+    if metric not in HEALTH_METRICS:
+        return f"지원하지 않는 지표입니다: '{metric}'. 사용 가능한 지표: {', '.join(HEALTH_METRICS)}"
+
+    user_id = tool_context.state.get("user_id")
+    if not user_id:
+        return "사용자 정보를 확인할 수 없어 추이를 조회하지 못했습니다."
+
+    try:
+        db = initialize_firebase()
+        rollups = get_metric_rollups(db, user_id, metric, granularity="weekly", periods=max(1, min(int(weeks), 12)))
+        return json.dumps(summarize_metric_trend(metric, rollups), ensure_ascii=False)
+    except Exception as e:
+        return f"건강 지표 추이 조회 중 오류가 발생했습니다: {e}"
@@ -0,0 +1,343 @@
+# proactive_scheduler.py
+
+import argparse
+import asyncio
+import contextvars
+import heapq
+import json
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from firebase_utils import (
+    get_users_by_status, get_latest_health_data, save_analysis_json, update_user_status,
+    mark_proactive_analysis_done, enqueue_notification, try_acquire_lease
+)
+from util import parse_ai_response, build_notification_content
+
+# 스케줄러가 사용자 대신 AI에게 보내는 질의
+PROACTIVE_QUERY = "최근 건강 데이터를 바탕으로 진행 중인 루틴을 점검하고 피드백을 주세요."
+
+# 알림 우선순위 (숫자가 낮을수록 먼저 전송)
+PRIORITY_RISK = 0
+PRIORITY_GOAL_ACHIEVED = 1
+PRIORITY_ROUTINE_FEEDBACK = 2
+
+DEFAULT_CHECKPOINT_PATH = "scheduler_checkpoint.json"
+# 이 시간보다 오래된 미완료 실행은 이어서 처리하지 않고 새 실행을 시작합니다. (한 번의 야간 실행 창 단위)
+DEFAULT_RESUME_MAX_AGE_HOURS = 12
+# 한 실행 안에서 이 횟수만큼 실패한 사용자는 더 시도하지 않고, 실행 완료 판단에서도 제외합니다.
+MAX_FAILED_ATTEMPTS = 3
+# 대상 사용자를 고를 때 사용자 문서에서 읽는 필드
+USER_SELECT_FIELDS = ["health_data_updated_at", "last_proactive_analysis_at"]
+# 여러 워커/서버 중 하나만 주기 실행을 하도록 잡는 임대 이름
+SCHEDULER_LEASE_NAME = "proactive_scheduler"
+
+# 스케줄러가 실행 중인 분석에서만 모델 호출 속도 제한을 적용하기 위한 컨텍스트 변수
+_model_rate_limiter: contextvars.ContextVar["RateLimiter | None"] = contextvars.ContextVar(
+    "proactive_model_rate_limiter", default=None
+)
+
+
+class RateLimiter:
+    """
+    모델 호출 속도 제한(분당 요청 수)을 지키기 위한 토큰 버킷입니다.
+    처음부터 분당 요청 수의 두 배가 나가지 않도록, 버킷은 burst개의 토큰만 가진 채로 시작합니다.
+    """
+
+    def __init__(self, requests_per_minute: int, burst: int = 1):
+        self.capacity = max(1, requests_per_minute)
+        self.tokens = float(min(self.capacity, burst))
+        self.refill_per_second = self.capacity / 60.0
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_per_second)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.refill_per_second)
+
+
+async def throttle_model_call(callback_context, llm_request):
+    """
+    에이전트의 before_model_callback으로 등록됩니다. 스케줄러가 실행한 분석이면 모델 요청마다 토큰을 하나씩 사용합니다.
+    (도구 호출 후 응답 생성, 상위 등급 재실행처럼 한 사용자의 분석에서 모델을 여러 번 호출하기 때문)
+    """
+    limiter = _model_rate_limiter.get()
+    if limiter is not None:
+        await limiter.acquire()
+    return None
+
+
+class Checkpoint:
+    """
+    실행 진행 상황을 로컬 파일에 기록하여, 중단된 실행을 이어서 처리할 수 있도록 합니다.
+    """
+
+    def __init__(self, path: str, resume_max_age_hours: float = DEFAULT_RESUME_MAX_AGE_HOURS):
+        self.path = path
+        self.resume_max_age = timedelta(hours=resume_max_age_hours)
+        self.run_id = None
+        self.started_at = None
+        self.done: set[str] = set()
+        self.failed: dict[str, str] = {}
+        self.attempts: dict[str, int] = {}
+        self.completed = False
+
+    def load_or_start(self, resume: bool):
+        """
+        미완료된 이전 실행이 있고 resume이 True이면 이어서, 아니면 새 실행을 시작합니다.
+        이전 실행이 resume_max_age보다 오래되었다면 완료 여부와 관계없이 새 실행을 시작하여,
+        지난 실행의 완료 목록 때문에 새 데이터가 있는 사용자가 계속 건너뛰어지지 않도록 합니다.
+        """
+        if resume and os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            started_at = datetime.fromisoformat(data["started_at"]) if data.get("started_at") else None
+            if not data.get("completed") and started_at and datetime.now() - started_at < self.resume_max_age:
+                self.run_id = data["run_id"]
+                self.started_at = started_at
+                self.done = set(data.get("done", []))
+                self.failed = data.get("failed", {})
+                self.attempts = data.get("attempts", {})
+                self.completed = False
+                print(f"♻️ 이전 실행 '{self.run_id}'을(를) 이어서 진행합니다. (완료 {len(self.done)}명)")
+                return
+        self.started_at = datetime.now()
+        self.run_id = self.started_at.strftime("%Y%m%d_%H%M%S_") + uuid.uuid4().hex[:6]
+        self.done, self.failed, self.attempts, self.completed = set(), {}, {}, False
+        self.save()
+
+    def record_failure(self, user_id: str, error: str):
+        self.failed[user_id] = error
+        self.attempts[user_id] = self.attempts.get(user_id, 0) + 1
+
+    def gave_up(self, user_id: str) -> bool:
+        """이번 실행에서 더 이상 시도하지 않을 사용자인지 확인합니다."""
+        return self.attempts.get(user_id, 0) >= MAX_FAILED_ATTEMPTS
+
+    def save(self):
+        data = {
+            "run_id": self.run_id,
+            "started_at": self.started_at.isoformat(),
+            "done": sorted(self.done),
+            "failed": self.failed,
+            "attempts": self.attempts,
+            "completed": self.completed,
+            "updated_at": datetime.now().isoformat()
+        }
+        # 쓰는 도중 중단되어도 파일이 깨지지 않도록 임시 파일에 쓴 뒤 교체합니다.
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+def _has_new_data(user_doc: dict) -> bool:
+    """마지막 선제적 분석 이후 새로운 건강 데이터가 들어왔는지 확인합니다."""
+    updated_at = user_doc.get("health_data_updated_at")
+    analyzed_at = user_doc.get("last_proactive_analysis_at")
+    if updated_at is None:
+        return False
+    return analyzed_at is None or updated_at > analyzed_at
+
+
+class ProactiveScheduler:
+    """
+    ROUTINE_IN_PROGRESS 상태의 사용자 중 새 데이터가 있는 사용자를 골라
+    제한된 워커 풀로 분석을 실행하고, 결과 저장과 알림 대기열 등록까지 처리합니다.
+    """
+
+    def __init__(self, manager, max_workers: int = 4, requests_per_minute: int = 60,
+                 batch_size: int = 50, checkpoint_path: str = DEFAULT_CHECKPOINT_PATH,
+                 resume_max_age_hours: float = DEFAULT_RESUME_MAX_AGE_HOURS):
+        self.manager = manager
+        self.db = manager.db
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        self.checkpoint = Checkpoint(checkpoint_path, resume_max_age_hours)
+        self._notifications: list[tuple[int, float, str, str, str]] = []
+
+    def select_users(self) -> list[tuple[str, dict]]:
+        """분석 대상 사용자(루틴 진행 중 + 새 데이터 있음)를 선택합니다."""
+        users = get_users_by_status(self.db, "ROUTINE_IN_PROGRESS", fields=USER_SELECT_FIELDS)
+        targets = [(user_id, doc) for user_id, doc in users if _has_new_data(doc)]
+        print(f"🗓️ 루틴 진행 중인 사용자 {len(users)}명 중 새 데이터가 있는 {len(targets)}명을 분석합니다.")
+        return targets
+
+    async def analyze_user(self, user_id: str, user_doc: dict):
+        """한 명의 사용자에 대해 분석을 실행하고 결과를 저장합니다."""
+        health_data = await asyncio.to_thread(get_latest_health_data, self.db, user_id)
+        if not health_data:
+            await asyncio.to_thread(mark_proactive_analysis_done, self.db, user_id)
+            return
+        session_id = f"proactive-{self.checkpoint.run_id}-{user_id}"
+        # 이 분석에서 일어나는 모든 모델 호출에 속도 제한을 적용합니다. (throttle_model_call)
+        _model_rate_limiter.set(self.rate_limiter)
+        # 스케줄러의 질의는 사용자가 보낸 메시지가 아니므로 대화 기록에 남기지 않습니다.
+        ai_raw_response = await self.manager.send_message_for_api(
+            PROACTIVE_QUERY, health_data, user_id, session_id, save_turn=False
+        )
+
+        response_data = parse_ai_response(ai_raw_response)
+        if response_data is None:
+            response_data = {"response_for_user": ai_raw_response.strip()}
+        # 전체 분석(analysis_json)은 ConversationManager가 이미 저장하므로, 루틴 피드백만 여기서 저장합니다.
+        if "analysis_json" not in response_data:
+            response_data["source"] = "proactive_scheduler"
+            # Firestore 쓰기는 블로킹 호출이므로 이벤트 루프를 막지 않도록 스레드에서 실행합니다.
+            await asyncio.to_thread(
+                save_analysis_json, self.db, user_id, session_id, dict(response_data), health_data
+            )
+
+        new_status = response_data.get("status_update")
+        if new_status:
+            await asyncio.to_thread(update_user_status, self.db, user_id, new_status)
+        await asyncio.to_thread(mark_proactive_analysis_done, self.db, user_id)
+
+        chat_text = response_data.get("response_for_user", "")
+        notification_content = build_notification_content(chat_text)
+        if notification_content:
+            self._queue_notification(PRIORITY_RISK, user_id, *notification_content)
+        elif new_status == "GOAL_ACHIEVED":
+            self._queue_notification(PRIORITY_GOAL_ACHIEVED, user_id, "목표 달성 🎉", "루틴 목표를 달성하셨어요! 앱에서 다음 목표를 정해보세요.")
+        else:
+            self._queue_notification(PRIORITY_ROUTINE_FEEDBACK, user_id, "루틴 점검 결과", "진행 중인 루틴에 대한 새로운 피드백이 도착했어요.")
+
+    def _queue_notification(self, priority: int, user_id: str, title: str, body: str):
+        heapq.heappush(self._notifications, (priority, time.time(), user_id, title, body))
+
+    async def _flush_notifications(self):
+        """쌓인 알림을 우선순위 순서대로 Firestore 알림 대기열에 등록합니다."""
+        while self._notifications:
+            priority, _, user_id, title, body = heapq.heappop(self._notifications)
+            await asyncio.to_thread(enqueue_notification, self.db, user_id, title, body, priority)
+
+    async def _worker(self, queue: asyncio.Queue, deadline: float | None):
+        while True:
+            try:
+                user_id, user_doc = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                if deadline is not None and time.monotonic() > deadline:
+                    # 정해진 실행 시간이 지나면 남은 사용자는 다음 실행에서 이어서 처리합니다.
+                    continue
+                await self.analyze_user(user_id, user_doc)
+                self.checkpoint.done.add(user_id)
+                self.checkpoint.failed.pop(user_id, None)
+            except Exception as e:
+                print(f"🚨 사용자 '{user_id}' 선제적 분석 중 오류 발생: {e}")
+                self.checkpoint.record_failure(user_id, str(e))
+            finally:
+                queue.task_done()
+
+    async def run_once(self, resume: bool = True, window_minutes: float | None = None) -> dict:
+        """
+        대상 사용자 전체를 배치 단위로 나누어 한 번 분석합니다.
+        window_minutes가 주어지면 그 시간 안에 시작하지 못한 사용자는 체크포인트에 남겨둡니다.
+        """
+        started = time.monotonic()
+        deadline = started + window_minutes * 60 if window_minutes else None
+        self.checkpoint.load_or_start(resume)
+
+        targets = await asyncio.to_thread(self.select_users)
+        pending = [
+            (user_id, doc) for user_id, doc in targets
+            if user_id not in self.checkpoint.done and not self.checkpoint.gave_up(user_id)
+        ]
+
+        for i in range(0, len(pending), self.batch_size):
+            if deadline is not None and time.monotonic() > deadline:
+                break
+            queue: asyncio.Queue = asyncio.Queue()
+            for item in pending[i:i + self.batch_size]:
+                queue.put_nowait(item)
+            workers = [asyncio.create_task(self._worker(queue, deadline)) for _ in range(self.max_workers)]
+            await asyncio.gather(*workers)
+            await self._flush_notifications()
+            self.checkpoint.save()
+
+        # 계속 실패한 사용자는 완료 판단에서 제외하여, 한 사용자 때문에 같은 실행이 계속 이어지지 않도록 합니다.
+        remaining = [
+            user_id for user_id, _ in pending
+            if user_id not in self.checkpoint.done and not self.checkpoint.gave_up(user_id)
+        ]
+        self.checkpoint.completed = not remaining
+        self.checkpoint.save()
+
+        summary = {
+            "run_id": self.checkpoint.run_id,
+            "targets": len(targets),
+            "done": len(self.checkpoint.done),
+            "failed": len(self.checkpoint.failed),
+            "remaining": len(remaining),
+            "elapsed_seconds": round(time.monotonic() - started, 1)
+        }
+        print(f"✅ 선제적 분석 실행 완료: {summary}")
+        return summary
+
+    async def run_forever(self, interval_minutes: float, window_minutes: float | None = None):
+        """
+        주기적으로 run_once를 실행합니다. 여러 워커/서버에서 실행되어도 Firestore 임대를 잡은 하나만 분석을 실행하여,
+        같은 사용자가 중복 분석/알림되거나 체크포인트가 서로 덮어써지지 않도록 합니다.
+        """
+        holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        # 실행 도중 임대가 만료되지 않도록 한 번의 실행 시간보다 넉넉하게 잡습니다.
+        run_lease_seconds = max(interval_minutes, window_minutes or interval_minutes) * 60 + 300
+        while True:
+            try:
+                if await asyncio.to_thread(try_acquire_lease, self.db, SCHEDULER_LEASE_NAME, holder, run_lease_seconds):
+                    await self.run_once(resume=True, window_minutes=window_minutes)
+                    # 다음 주기까지 다른 워커가 임대를 가져가지 않도록 실행이 끝난 시점부터 다시 연장합니다.
+                    await asyncio.to_thread(
+                        try_acquire_lease, self.db, SCHEDULER_LEASE_NAME, holder, interval_minutes * 60 + 300
+                    )
+                else:
+                    print("ℹ️ 다른 워커가 선제적 분석을 실행 중이므로 이번 주기는 건너뜁니다.")
+            except Exception as e:
+                print(f"🚨 선제적 분석 스케줄러 실행 중 오류 발생: {e}")
+            await asyncio.sleep(interval_minutes * 60)
+
+
+async def _main(args):
+    from main import ConversationManager
+    from multi_tool_agent.agent import root_agent
+
+    manager = ConversationManager(agent=root_agent)
+    await manager.initialize()
+    scheduler = ProactiveScheduler(
+        manager,
+        max_workers=args.workers,
+        requests_per_minute=args.rpm,
+        batch_size=args.batch_size,
+        checkpoint_path=args.checkpoint,
+        resume_max_age_hours=args.resume_max_age_hours
+    )
+    if args.interval_minutes:
+        await scheduler.run_forever(args.interval_minutes, args.window_minutes)
+    else:
+        await scheduler.run_once(resume=not args.fresh, window_minutes=args.window_minutes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="루틴 진행 중인 사용자에 대한 선제적 배치 분석 워커")
+    parser.add_argument("--workers", type=int, default=4, help="동시에 실행할 분석 작업 수")
+    parser.add_argument("--rpm", type=int, default=60, help="분당 최대 모델 요청 수")
+    parser.add_argument("--batch-size", type=int, default=50, help="체크포인트를 저장할 배치 크기")
+    parser.add_argument("--window-minutes", type=float, default=None, help="이 시간이 지나면 새 분석을 시작하지 않음")
+    parser.add_argument("--interval-minutes", type=float, default=None, help="지정하면 이 주기로 계속 실행")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT_PATH, help="체크포인트 파일 경로")
+    parser.add_argument("--resume-max-age-hours", type=float, default=DEFAULT_RESUME_MAX_AGE_HOURS,
+                        help="이보다 오래된 미완료 실행은 이어서 처리하지 않음")
+    parser.add_argument("--fresh", action="store_true", help="이전 체크포인트를 무시하고 새로 시작")
+    asyncio.run(_main(parser.parse_args()))
@@ -0,0 +1,92 @@
+# replay_trace.py
+
+import argparse
+import asyncio
+import os
+import tracemalloc
+from collections import defaultdict
+
+# main.py와 에이전트가 사용하는 것과 같은 모듈을 가져와야 재실행 기록(컨텍스트 변수)이 공유됩니다.
+import request_trace
+
+
+class _OfflineDatabase:
+    """재실행 중 Firestore에 실제로 접근하려 하면 바로 알 수 있도록 오류를 냅니다."""
+
+    def __getattr__(self, name):
+        raise request_trace.ReplayMismatch(f"재실행 중 기록되지 않은 Firestore 접근이 발생했습니다: db.{name}")
+
+
+def _print_breakdown(data: dict, replay_trace: request_trace.RequestTrace):
+    print("\n=== 단계별 소요 시간 (기록 시점 vs 재실행) ===")
+    replay_stages = {s["name"]: s for s in replay_trace.stages}
+    print(f"{'단계':<24}{'기록(ms)':>12}{'재실행(ms)':>14}{'할당(KB)':>12}{'최대(KB)':>12}")
+    for recorded in data.get("stages", []):
+        replayed = replay_stages.get(recorded["name"], {})
+        print(f"{recorded['name']:<24}{recorded['duration_ms']:>12}{replayed.get('duration_ms', '-'):>14}"
+              f"{replayed.get('allocated_kb', '-'):>12}{replayed.get('peak_kb', '-'):>12}")
+    print(f"{'total':<24}{data.get('total_ms', '-'):>12}{replay_trace._offset_ms():>14}")
+
+    print("\n=== 외부 호출별 소요 시간 (기록 시점) ===")
+    totals = defaultdict(lambda: [0, 0.0])
+    for event in data.get("events", []):
+        label = f"{event['kind']}:{event['name']}"
+        totals[label][0] += 1
+        totals[label][1] += event.get("duration_ms") or 0.0
+    for label, (count, total_ms) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        print(f"{label:<48}{count:>6}회{round(total_ms, 2):>12}ms")
+
+
+def _replay(args):
+    # 재실행은 오프라인으로 진행하므로 프롬프트 캐시를 만들지 않습니다.
+    os.environ["PROMPT_CACHE_ENABLED"] = "0"
+    from main import ConversationManager
+    from multi_tool_agent.agent import root_agent
+
+    data = request_trace.load_trace(args.trace_file)
+    manager = ConversationManager(agent=root_agent, db=_OfflineDatabase())
+    inputs = data["inputs"]
+
+    async def run():
+        trace = request_trace.start_replay(data)
+        output = await manager._send_message(**inputs)
+        return trace, output
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    profiler = None
+    if args.profiler == "cprofile":
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif args.profiler == "pyinstrument":
+        from pyinstrument import Profiler
+        profiler = Profiler(async_mode="enabled")
+        profiler.start()
+
+    trace, output = asyncio.run(run())
+
+    if args.profiler == "cprofile":
+        import pstats
+        profiler.disable()
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(args.top)
+    elif args.profiler == "pyinstrument":
+        profiler.stop()
+        print(profiler.output_text(unicode=True))
+
+    _print_breakdown(data, trace)
+    if args.tracemalloc:
+        print("\n=== 메모리 할당 상위 위치 ===")
+        for stat in tracemalloc.take_snapshot().statistics("lineno")[:args.top]:
+            print(stat)
+        tracemalloc.stop()
+    print(f"\n응답이 기록과 {'일치합니다' if output == data.get('output') else '다릅니다'}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="기록된 /chat 요청을 오프라인으로 재실행하고 프로파일링합니다.")
+    parser.add_argument("trace_file", help="traces/ 아래의 .json.gz 기록 파일")
+    parser.add_argument("--profiler", choices=["none", "cprofile", "pyinstrument"], default="cprofile")
+    parser.add_argument("--tracemalloc", action="store_true", help="단계별 메모리 할당량을 측정합니다.")
+    parser.add_argument("--top", type=int, default=25, help="프로파일 결과에서 출력할 항목 수")
+    _replay(parser.parse_args())
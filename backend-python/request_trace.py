@@ -0,0 +1,255 @@
+# request_trace.py
+
+import contextvars
+import functools
+import gzip
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from datetime import datetime
+
+# REQUEST_TRACE=1 이면 모든 요청을 기록합니다.
+TRACE_ALL_REQUESTS = os.getenv("REQUEST_TRACE", "0") == "1"
+# REQUEST_TRACE_ALLOW_HEADER=1 일 때만 X-Record-Trace: 1 헤더로 개별 요청의 기록을 요청할 수 있습니다.
+# (기록에는 건강 데이터가 포함되므로, 기본값은 클라이언트가 기록을 켤 수 없도록 함)
+ALLOW_TRACE_HEADER = os.getenv("REQUEST_TRACE_ALLOW_HEADER", "0") == "1"
+TRACE_DIR = os.getenv("REQUEST_TRACE_DIR", "traces")
+# 보관할 기록 파일의 최대 개수와 최대 보관 기간(일). 넘으면 오래된 파일부터 지웁니다.
+TRACE_MAX_FILES = int(os.getenv("REQUEST_TRACE_MAX_FILES", "100"))
+TRACE_MAX_AGE_DAYS = float(os.getenv("REQUEST_TRACE_MAX_AGE_DAYS", "7"))
+
+_current_trace: contextvars.ContextVar["RequestTrace | None"] = contextvars.ContextVar("request_trace", default=None)
+
+
+class ReplayMismatch(Exception):
+    """재실행 중 기록에 없는 호출이 발생했을 때 발생합니다. (코드가 기록 시점과 다르게 동작하는 경우)"""
+
+
+def _json_safe(value):
+    return json.loads(json.dumps(value, ensure_ascii=False, default=str))
+
+
+def _is_recordable(value) -> bool:
+    return value is None or isinstance(value, (str, int, float, bool, dict, list, tuple))
+
+
+def _args_key(args: tuple, kwargs: dict) -> str:
+    """호출 인자로 기록을 찾는 키를 만듭니다. db 클라이언트나 tool_context처럼 기록할 수 없는 인자는 제외합니다."""
+    recordable_args = [arg for arg in args if _is_recordable(arg)]
+    recordable_kwargs = {k: v for k, v in kwargs.items() if _is_recordable(v)}
+    return json.dumps([recordable_args, recordable_kwargs], sort_keys=True, ensure_ascii=False, default=str)
+
+
+class RequestTrace:
+    """
+    한 번의 send_message_for_api 실행에서 발생한 입력, Firestore/공유 캐시 조회, 도구 결과, 모델 응답과
+    단계별 소요 시간을 담는 기록입니다. mode가 'replay'이면 기록된 결과를 돌려주어 같은 요청을 오프라인으로 재실행합니다.
+    """
+
+    def __init__(self, mode: str, inputs: dict, data: dict | None = None):
+        self.mode = mode
+        self.inputs = inputs
+        self.started = time.perf_counter()
+        self.events: list[dict] = []
+        self.stages: list[dict] = []
+        self.output = None
+        self._lock = threading.Lock()
+        self._model_started: dict[str, float] = {}
+        self.recorded = data or {}
+        # 재실행 시 (종류, 이름, 인자)별로 기록된 결과를 순서대로 꺼내 씁니다.
+        self._replay_calls: dict[tuple, deque] = defaultdict(deque)
+        self._replay_models: deque = deque()
+        for event in self.recorded.get("events", []):
+            if event["kind"] == "model":
+                self._replay_models.append(event)
+            else:
+                self._replay_calls[(event["kind"], event["name"], event["args_key"])].append(event)
+
+    def _offset_ms(self) -> float:
+        return round((time.perf_counter() - self.started) * 1000, 2)
+
+    def add_event(self, event: dict):
+        with self._lock:
+            self.events.append(event)
+
+    def take_recorded(self, kind: str, name: str, args_key: str) -> dict | None:
+        with self._lock:
+            queue = self._replay_calls.get((kind, name, args_key))
+            if not queue:
+                # 공유 캐시 조회는 기록 시점에 워밍업으로 준비된 세션을 사용했다면 일어나지 않았을 수 있습니다.
+                if kind == "state":
+                    return None
+                raise ReplayMismatch(f"기록에 없는 호출입니다: {kind}:{name} {args_key}")
+            return queue.popleft()
+
+    def take_model_response(self) -> dict:
+        with self._lock:
+            if not self._replay_models:
+                raise ReplayMismatch("기록된 모델 응답을 모두 사용했습니다.")
+            return self._replay_models.popleft()
+
+    def to_dict(self) -> dict:
+        return {
+            "version": 1,
+            "recorded_at": datetime.now().isoformat(),
+            "inputs": self.inputs,
+            "output": self.output,
+            "total_ms": self._offset_ms(),
+            "stages": self.stages,
+            "events": self.events
+        }
+
+
+def current_trace() -> RequestTrace | None:
+    return _current_trace.get()
+
+
+def should_record(headers=None) -> bool:
+    """REQUEST_TRACE=1 이거나, 서버가 헤더 기록을 허용했고(REQUEST_TRACE_ALLOW_HEADER=1) 요청에 X-Record-Trace: 1 헤더가 있으면 기록합니다."""
+    if TRACE_ALL_REQUESTS:
+        return True
+    return ALLOW_TRACE_HEADER and bool(headers) and headers.get("x-record-trace") == "1"
+
+
+def start_recording(inputs: dict) -> RequestTrace:
+    trace = RequestTrace("record", _json_safe(inputs))
+    _current_trace.set(trace)
+    return trace
+
+
+def finish_recording(trace: RequestTrace) -> str:
+    """기록을 gzip으로 압축한 JSON 파일로 저장하고 파일 경로를 반환합니다."""
+    _current_trace.set(None)
+    os.makedirs(TRACE_DIR, exist_ok=True)
+    user_id = str(trace.inputs.get("user_id", "unknown")).replace("/", "_")
+    filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{user_id}.json.gz"
+    path = os.path.join(TRACE_DIR, filename)
+    data = trace.to_dict()
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"), default=str)
+    print(f"🧾 요청 기록을 저장했습니다: {path} (총 {data['total_ms']}ms)")
+    _enforce_retention()
+    return path
+
+
+def _enforce_retention():
+    """보관 기간이 지났거나 최대 개수를 넘는 기록 파일을 오래된 것부터 지웁니다."""
+    paths = sorted(
+        (os.path.join(TRACE_DIR, name) for name in os.listdir(TRACE_DIR) if name.endswith(".json.gz")),
+        key=os.path.getmtime
+    )
+    expires_before = time.time() - TRACE_MAX_AGE_DAYS * 24 * 60 * 60
+    excess = max(0, len(paths) - TRACE_MAX_FILES)
+    for index, path in enumerate(paths):
+        if index < excess or os.path.getmtime(path) < expires_before:
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"⚠️ 오래된 요청 기록 삭제 실패 ({path}): {e}")
+
+
+def load_trace(path: str) -> dict:
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def start_replay(data: dict) -> RequestTrace:
+    trace = RequestTrace("replay", data["inputs"], data)
+    _current_trace.set(trace)
+    return trace
+
+
+def _call(trace: RequestTrace, kind: str, name: str, args_key: str, call):
+    if trace.mode == "replay":
+        recorded = trace.take_recorded(kind, name, args_key)
+        return recorded["result"] if recorded else None
+    offset = trace._offset_ms()
+    started = time.perf_counter()
+    result = call()
+    trace.add_event({
+        "kind": kind, "name": name, "args_key": args_key, "result": _json_safe(result),
+        "offset_ms": offset, "duration_ms": round((time.perf_counter() - started) * 1000, 2)
+    })
+    return result
+
+
+def traced_call(kind: str, name: str, func, *args, **kwargs):
+    """
+    Firestore 조회/저장처럼 외부에 의존하는 호출을 기록하거나, 재실행 시 기록된 결과로 대신합니다.
+    기록 중이 아니면 func를 그대로 호출합니다.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return func(*args, **kwargs)
+    return _call(trace, kind, name, _args_key(args, kwargs), lambda: func(*args, **kwargs))
+
+
+def traced_tool(func):
+    """에이전트 도구를 감싸 결과를 기록하거나, 재실행 시 기록된 결과를 돌려줍니다. (시그니처와 설명은 그대로 유지)"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        trace = _current_trace.get()
+        if trace is None:
+            return func(*args, **kwargs)
+        return _call(trace, "tool", func.__name__, _args_key(args, kwargs), lambda: func(*args, **kwargs))
+
+    return wrapper
+
+
+@contextmanager
+def stage(name: str):
+    """
+    send_message_for_api의 한 단계를 측정합니다. 소요 시간과, tracemalloc이 켜져 있으면 메모리 할당량도 기록합니다.
+    기록 중이 아니면 아무 일도 하지 않습니다.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    tracing_memory = tracemalloc.is_tracing()
+    if tracing_memory:
+        tracemalloc.reset_peak()
+        memory_before, _ = tracemalloc.get_traced_memory()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry = {"name": name, "duration_ms": round((time.perf_counter() - started) * 1000, 2)}
+        if tracing_memory:
+            memory_after, peak = tracemalloc.get_traced_memory()
+            entry["allocated_kb"] = round((memory_after - memory_before) / 1024, 1)
+            entry["peak_kb"] = round((peak - memory_before) / 1024, 1)
+        trace.stages.append(entry)
+
+
+# --- ADK 모델 콜백 ---
+def before_model(callback_context, llm_request):
+    """재실행 중이면 모델을 호출하지 않고 기록된 응답을 돌려줍니다. 기록 중이면 모델 호출 시작 시각을 남깁니다."""
+    trace = _current_trace.get()
+    if trace is None:
+        return None
+    if trace.mode == "replay":
+        from google.adk.models import LlmResponse
+        return LlmResponse.model_validate(trace.take_model_response()["response"])
+    trace._model_started[callback_context.invocation_id] = time.perf_counter()
+    return None
+
+
+def after_model(callback_context, llm_response):
+    """모델 응답(텍스트, 도구 호출, 토큰 사용량)을 기록합니다."""
+    trace = _current_trace.get()
+    if trace is None or trace.mode != "record":
+        return None
+    started = trace._model_started.pop(callback_context.invocation_id, None)
+    duration_ms = round((time.perf_counter() - started) * 1000, 2) if started else None
+    trace.add_event({
+        "kind": "model", "name": getattr(llm_response, "model_version", None) or "model",
+        "args_key": "", "response": llm_response.model_dump(mode="json", exclude_none=True),
+        "offset_ms": trace._offset_ms() - (duration_ms or 0), "duration_ms": duration_ms
+    })
+    return None
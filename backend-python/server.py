@@ -1,18 +1,31 @@
 # backend-python/server.py
 
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ValidationError
 import uvicorn
-from typing import Optional, Dict, Any
-import json
+from typing import Optional
+import os
+import asyncio
 
 # main.py에서 ConversationManager 클래스와 root_agent를 가져옵니다.
 from main import ConversationManager
 from multi_tool_agent.agent import root_agent
+from multi_tool_agent.model_tiers import tier_stats
 
 # [수정] firebase_utils와 util 파일에서 필요한 함수들을 모두 가져옵니다.
-from firebase_utils import update_user_status
-from util import is_data_sufficient, get_health_questionnaire
+from firebase_utils import update_user_status, save_latest_health_data, get_metric_rollups
+from proactive_scheduler import ProactiveScheduler
+from health_schema import HealthData
+from wire_format import (
+    CompressionMiddleware, UnsupportedMediaType, decode_body, encode_body, dumps_json_text,
+    JSON_MEDIA_TYPE, MSGPACK_MEDIA_TYPES, CBOR_MEDIA_TYPE
+)
+from util import (
+    is_data_sufficient, get_health_questionnaire, build_notification_content, parse_ai_response,
+    HEALTH_METRICS, summarize_metric_trend
+)
+import request_trace
 
 
 # --- 데이터 모델 정의 ---
@@ -24,7 +37,11 @@ class ChatRequest(BaseModel):
     userId: str
     sessionId: str
     message: str
-    healthData: Optional[Dict[str, Any]] = None
+    healthData: Optional[HealthData] = None
+
+class WarmupRequest(BaseModel):
+    userId: str
+    sessionId: str
 
 class ChatResponse(BaseModel):
     chatResponse: str
@@ -32,7 +49,23 @@ class ChatResponse(BaseModel):
 
 # --- FastAPI 앱 설정 ---
 app = FastAPI()
+# gzip/deflate로 압축된 요청을 풀고, 응답은 클라이언트가 지원하는 방식으로 압축합니다.
+app.add_middleware(CompressionMiddleware)
 manager: Optional[ConversationManager] = None
+# 응답을 기다리게 하지 않는 백그라운드 작업 (완료 전에 가비지 컬렉션되지 않도록 참조를 유지)
+_background_tasks: set[asyncio.Task] = set()
+
+def _run_in_background(func, *args):
+    """블로킹 함수를 스레드에서 실행하고 결과를 기다리지 않습니다. 오류는 로그로만 남깁니다."""
+    async def run():
+        try:
+            await asyncio.to_thread(func, *args)
+        except Exception as e:
+            print(f"🚨 백그라운드 작업 '{func.__name__}' 중 오류 발생: {e}")
+
+    task = asyncio.create_task(run())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
 
 @app.on_event("startup")
 async def startup_event():
@@ -40,6 +73,22 @@ async def startup_event():
     global manager
     manager = ConversationManager(agent=root_agent)
     await manager.initialize()
+
+    # PROACTIVE_SCHEDULER_INTERVAL_MINUTES가 설정되어 있으면 서버 프로세스 안에서 선제적 분석을 주기적으로 실행합니다.
+    # 워커/서버가 여러 개여도 Firestore 임대를 잡은 하나만 실제로 분석을 실행합니다. (ProactiveScheduler.run_forever)
+    # PROACTIVE_SCHEDULER_WINDOW_MINUTES를 설정하면 한 번의 실행을 그 시간 안에 고르게 나누어 요청합니다.
+    interval_minutes = os.getenv("PROACTIVE_SCHEDULER_INTERVAL_MINUTES")
+    if interval_minutes:
+        window_minutes = os.getenv("PROACTIVE_SCHEDULER_WINDOW_MINUTES")
+        scheduler = ProactiveScheduler(
+            manager,
+            max_workers=int(os.getenv("PROACTIVE_SCHEDULER_WORKERS", "4")),
+            requests_per_minute=int(os.getenv("PROACTIVE_SCHEDULER_RPM", "60"))
+        )
+        asyncio.create_task(scheduler.run_forever(
+            float(interval_minutes), float(window_minutes) if window_minutes else None
+        ))
+        print(f"🗓️ 선제적 분석 스케줄러를 {interval_minutes}분 주기로 시작합니다.")
     print("🤖 FastAPI 서버와 AI 코치가 준비되었습니다.")
 
 @app.get("/")
@@ -47,28 +96,111 @@ def read_root():
     """서버 상태 확인용 기본 경로입니다."""
     return {"status": "WellnessCoach AI Server is running"}
 
-@app.post("/chat", response_model=ChatResponse)
-async def handle_chat(request: ChatRequest):
+@app.get("/metrics/model-tiers")
+def get_model_tier_metrics():
+    """모델 등급별 호출 수, 지연 시간, 토큰 사용량, 추정 비용, 승격 횟수를 반환합니다."""
+    return {"tiers": tier_stats.snapshot()}
+
+@app.post("/warmup", status_code=202)
+async def warmup(request: WarmupRequest):
+    """
+    앱의 채팅 화면이 열릴 때 호출됩니다. 사용자 데이터와 세션 준비를 백그라운드로 시작하고 즉시 응답합니다.
+    """
+    if not manager:
+        raise HTTPException(status_code=503, detail="AI Manager is not initialized")
+    started = manager.warm_up(request.userId, request.sessionId)
+    return {"status": "warming" if started else "already_warming"}
+
+@app.get("/users/{user_id}/trends")
+def get_health_trend(user_id: str, metric: str, granularity: str = "weekly", periods: int = 4):
+    """
+    사용자의 건강 지표 추이를 일별/주별 롤업으로 조회합니다.
+    예: /users/user_1/trends?metric=deep_sleep_minutes&granularity=weekly&periods=4
+    """
+    if not manager:
+        raise HTTPException(status_code=503, detail="AI Manager is not initialized")
+    if metric not in HEALTH_METRICS:
+        raise HTTPException(status_code=400, detail=f"Unsupported metric: {metric}")
+    if granularity not in ("daily", "weekly"):
+        raise HTTPException(status_code=400, detail="granularity must be 'daily' or 'weekly'")
+    if not 1 <= periods <= 90:
+        raise HTTPException(status_code=400, detail="periods must be between 1 and 90")
+
+    rollups = get_metric_rollups(manager.db, user_id, metric, granularity=granularity, periods=periods)
+    return summarize_metric_trend(metric, rollups)
+
+# /chat은 본문을 직접 해석하므로, API 문서에 요청 본문 형식을 따로 선언합니다.
+_CHAT_REQUEST_SCHEMA = ChatRequest.model_json_schema(ref_template="#/components/schemas/{model}")
+_CHAT_REQUEST_DEFS = _CHAT_REQUEST_SCHEMA.pop("$defs", {})
+_default_openapi = app.openapi
+
+def _openapi_with_chat_request():
+    """기본 OpenAPI 문서에 ChatRequest와 그 하위 모델의 스키마를 추가합니다."""
+    schema = _default_openapi()
+    schemas = schema.setdefault("components", {}).setdefault("schemas", {})
+    schemas.update(_CHAT_REQUEST_DEFS)
+    schemas["ChatRequest"] = _CHAT_REQUEST_SCHEMA
+    return schema
+
+app.openapi = _openapi_with_chat_request
+
+@app.post("/chat", response_model=ChatResponse, openapi_extra={
+    "requestBody": {
+        "required": True,
+        "content": {
+            media_type: {"schema": {"$ref": "#/components/schemas/ChatRequest"}}
+            for media_type in (JSON_MEDIA_TYPE, MSGPACK_MEDIA_TYPES[0], CBOR_MEDIA_TYPE)
+        }
+    }
+})
+async def handle_chat(http_request: Request):
     """
     안드로이드 앱의 모든 요청을 처리하는 메인 API 엔드포인트입니다.
+    요청 본문은 JSON 외에 MessagePack/CBOR(Content-Type으로 지정)도 받을 수 있으며,
+    응답은 Accept 헤더에 맞춰 같은 형식으로 돌려줍니다.
     """
     if not manager:
         raise HTTPException(status_code=503, detail="AI Manager is not initialized")
 
-    print(f"Received data from Android: {request.dict()}")
+    body = await http_request.body()
+    try:
+        request = ChatRequest.model_validate(decode_body(body, http_request.headers.get("content-type")))
+    except UnsupportedMediaType as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Malformed request body: {e}")
+
+    # 건강 데이터는 여기서 한 번만 dict와 JSON 문자열로 변환하여 이후 단계에서 재사용합니다.
+    health_data = request.healthData.to_payload() if request.healthData else None
+    try:
+        health_data_json = dumps_json_text(health_data) if health_data else None
+    except TypeError as e:
+        # 바이너리 본문(MessagePack/CBOR)의 추가 필드에 JSON으로 표현할 수 없는 값(바이트, 정수 맵 키 등)이 있는 경우
+        # (orjson.JSONEncodeError도 TypeError의 하위 클래스)
+        raise HTTPException(status_code=400, detail=f"Malformed request body: {e}")
+    print(f"📥 /chat 요청: user='{request.userId}', session='{request.sessionId}', "
+          f"메시지 {len(request.message)}자, 건강 데이터 항목 {sorted(health_data) if health_data else []}, 본문 {len(body)}바이트")
+
+    # 선제적 분석 스케줄러가 사용할 수 있도록 최신 건강 데이터를 저장합니다. (응답 지연에 포함되지 않도록 백그라운드에서)
+    if health_data:
+        _run_in_background(save_latest_health_data, manager.db, request.userId, health_data)
 
     # "분석" 요청 시 데이터 충분성 검사 로직은 유지합니다.
     if "분석" in request.message or "분석해줘" in request.message:
-        if not is_data_sufficient(request.healthData):
+        if not is_data_sufficient(health_data):
             questionnaire = get_health_questionnaire()
             # [핵심 추가] 설문지를 보내는 동시에, 사용자의 상태를 '설문 답변 대기중'으로 변경
             update_user_status(manager.db, request.userId, "AWAITING_SURVEY_RESPONSE")
             print(f"🔄 데이터 부족으로 설문지 전송. 사용자 상태를 'AWAITING_SURVEY_RESPONSE'로 변경.")
-            return ChatResponse(chatResponse=questionnaire)
+            return _encode_chat_response(ChatResponse(chatResponse=questionnaire), http_request)
 
     # [핵심 수정] main.py의 send_message_for_api 호출 시 userId와 sessionId를 전달하도록 변경합니다.
     ai_raw_response = await manager.send_message_for_api(
-        request.message, request.healthData, request.userId, request.sessionId
+        request.message, health_data, request.userId, request.sessionId, health_data_json=health_data_json,
+        # 서버가 허용한 경우(REQUEST_TRACE_ALLOW_HEADER=1) X-Record-Trace: 1 헤더로 이 요청을 기록하여 오프라인 재실행/프로파일링에 사용합니다.
+        record_trace=request_trace.should_record(http_request.headers)
     )
     
     chat_text_for_user = "" 
@@ -76,26 +208,27 @@ async def handle_chat(request: ChatRequest):
 
     try:
         # [핵심 수정] AI 응답을 json으로 먼저 파싱 시도합니다.
-        response_data = json.loads(ai_raw_response)
-        chat_text_for_user = response_data.get("response_for_user", "오류: AI 응답 형식이 잘못되었습니다.")
-
-        # [핵심 추가] AI가 상태 변경을 요청했는지 확인하고 DB를 업데이트합니다.
-        if "status_update" in response_data:
-            new_status = response_data["status_update"]
-            # manager.db를 통해 firestore 클라이언트에 접근합니다.
-            update_user_status(manager.db, request.userId, new_status)
-            print(f"🔄 AI 요청에 따라 사용자 상태를 '{new_status}'(으)로 변경했습니다.")
-        
-        # 기존 알림 생성 로직은 그대로 유지합니다.
-        if "[🚨 위험 요소]" in chat_text_for_user:
-            if "수면" in chat_text_for_user:
-                notification_payload = NotificationPayload(title="수면 부족 경고", body="어젯밤 수면의 질이 좋지 않았습니다. 앱에서 확인해보세요.")
-            elif "스트레스" in chat_text_for_user:
-                 notification_payload = NotificationPayload(title="높은 스트레스 감지", body="스트레스 지수가 높게 측정되었습니다. 휴식이 필요합니다.")
-
-    except json.JSONDecodeError:
-        # JSON 파싱에 실패하면 일반 텍스트 응답으로 간주합니다.
-        chat_text_for_user = ai_raw_response.strip()
+        # 응답 형식 검사(meets_response_contract)와 같은 파서를 사용하여 ```json 코드 블록으로 감싼 응답도 처리합니다.
+        response_data = parse_ai_response(ai_raw_response)
+        if response_data is None:
+            # JSON 파싱에 실패하면 일반 텍스트 응답으로 간주합니다.
+            chat_text_for_user = ai_raw_response.strip()
+        else:
+            chat_text_for_user = response_data.get("response_for_user", "오류: AI 응답 형식이 잘못되었습니다.")
+
+            # [핵심 추가] AI가 상태 변경을 요청했는지 확인하고 DB를 업데이트합니다.
+            if "status_update" in response_data:
+                new_status = response_data["status_update"]
+                # manager.db를 통해 firestore 클라이언트에 접근합니다.
+                update_user_status(manager.db, request.userId, new_status)
+                print(f"🔄 AI 요청에 따라 사용자 상태를 '{new_status}'(으)로 변경했습니다.")
+            
+            # 기존 알림 생성 로직은 그대로 유지합니다.
+            notification_content = build_notification_content(chat_text_for_user)
+            if notification_content:
+                title, body = notification_content
+                notification_payload = NotificationPayload(title=title, body=body)
+
     except Exception as e:
         print(f"Error processing AI response: {e}")
         chat_text_for_user = "AI 응답을 처리하는 중 오류가 발생했습니다."
@@ -108,7 +241,13 @@ async def handle_chat(request: ChatRequest):
         )
         chat_text_for_user += guidance_message
 
-    return ChatResponse(
+    return _encode_chat_response(ChatResponse(
         chatResponse=chat_text_for_user,
         notification=notification_payload
-    )
\ No newline at end of file
+    ), http_request)
+
+
+def _encode_chat_response(chat_response: ChatResponse, http_request: Request) -> Response:
+    """Accept 헤더에 맞춰 응답을 JSON/MessagePack/CBOR로 인코딩합니다."""
+    content, media_type = encode_body(chat_response.model_dump(), http_request.headers.get("accept"))
+    return Response(content=content, media_type=media_type)
\ No newline at end of file
@@ -0,0 +1,390 @@
+# shared_state.py
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable
+from urllib.parse import urlparse
+
+# 여러 워커/서버가 캐시 무효화 메시지를 주고받는 채널 이름
+INVALIDATION_CHANNEL = "wellness_coach:invalidate"
+# 메모리 저장소에 보관하는 최대 항목 수. 넘으면 가장 오래 사용하지 않은 항목부터 지웁니다.
+DEFAULT_MEMORY_MAX_ENTRIES = 10000
+# 메모리 저장소에서 만료된 항목을 정리하는 주기(초)
+MEMORY_SWEEP_INTERVAL_SECONDS = 60
+# Firestore 무효화 문서를 보관하는 시간(초). 리스너는 추가된 문서만 받으므로 그 뒤에는 필요하지 않습니다.
+FIRESTORE_INVALIDATION_RETENTION_SECONDS = 3600
+
+
+class StateBackend(ABC):
+    """
+    세션, 사용자 상태, 도구/응답 캐시를 저장하는 공유 상태 저장소의 기본 인터페이스입니다.
+    값은 JSON으로 직렬화 가능한 객체여야 합니다.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Any | None:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: Any, ttl_seconds: float | None = None):
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    def publish_invalidation(self, message: str):
+        """다른 프로세스/노드에 무효화 메시지를 전파합니다. (단일 프로세스 저장소에서는 아무 일도 하지 않음)"""
+
+    def subscribe_invalidations(self, callback: Callable[[str], None]):
+        """다른 프로세스/노드에서 보낸 무효화 메시지를 받을 콜백을 등록합니다."""
+
+
+class InProcessBackend(StateBackend):
+    """
+    프로세스 메모리에 값을 저장하는 저장소입니다. 단일 워커 실행 및 L1 캐시로 사용합니다.
+    항목 수가 max_entries를 넘으면 가장 오래 사용하지 않은 항목부터 지우고, 만료된 항목은 주기적으로 정리합니다.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MEMORY_MAX_ENTRIES,
+                 sweep_interval_seconds: float = MEMORY_SWEEP_INTERVAL_SECONDS):
+        self._data: OrderedDict[str, tuple[float | None, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+        self.sweep_interval_seconds = sweep_interval_seconds
+        self._next_sweep_at = time.monotonic() + sweep_interval_seconds
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl_seconds: float | None = None):
+        now = time.monotonic()
+        expires_at = now + ttl_seconds if ttl_seconds else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            if now >= self._next_sweep_at:
+                self._sweep(now)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def _sweep(self, now: float):
+        """다시 조회되지 않는 키도 메모리에 남지 않도록 만료된 항목을 모두 지웁니다. (잠금을 잡은 상태에서 호출)"""
+        expired = [key for key, (expires_at, _) in self._data.items() if expires_at is not None and expires_at < now]
+        for key in expired:
+            del self._data[key]
+        self._next_sweep_at = now + self.sweep_interval_seconds
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class RedisBackend(StateBackend):
+    """
+    Redis 프로토콜(RESP)을 사용하는 저장소입니다. 로컬 소켓으로 Redis 호환 서버에 접속하며,
+    캐시 무효화는 Redis pub/sub 채널로 전파합니다.
+    """
+
+    def __init__(self, url: str):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.db_index = int(parsed.path.lstrip("/") or 0)
+        self.password = parsed.password
+        self._lock = threading.Lock()
+        self._sock = None
+        self._reader = None
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=5)
+        reader = sock.makefile("rb")
+        if self.password:
+            self._send(sock, reader, "AUTH", self.password)
+        if self.db_index:
+            self._send(sock, reader, "SELECT", str(self.db_index))
+        return sock, reader
+
+    @staticmethod
+    def _encode(*args: str) -> bytes:
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg.encode("utf-8")
+            parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        return b"".join(parts)
+
+    @classmethod
+    def _read_reply(cls, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("Redis 연결이 끊어졌습니다.")
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b"+":
+            return payload.decode("utf-8")
+        if prefix == b"-":
+            raise RuntimeError(f"Redis 오류: {payload.decode('utf-8')}")
+        if prefix == b":":
+            return int(payload)
+        if prefix == b"$":
+            length = int(payload)
+            if length == -1:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2].decode("utf-8")
+        if prefix == b"*":
+            length = int(payload)
+            if length == -1:
+                return None
+            return [cls._read_reply(reader) for _ in range(length)]
+        raise RuntimeError(f"알 수 없는 Redis 응답 형식: {line!r}")
+
+    def _send(self, sock, reader, *args: str):
+        sock.sendall(self._encode(*args))
+        return self._read_reply(reader)
+
+    def _command(self, *args: str):
+        with self._lock:
+            # 연결이 끊어진 경우 한 번만 다시 연결하여 재시도합니다.
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._sock, self._reader = self._connect()
+                    return self._send(self._sock, self._reader, *args)
+                except (ConnectionError, OSError):
+                    self._sock, self._reader = None, None
+                    if attempt == 1:
+                        raise
+
+    def get(self, key: str) -> Any | None:
+        raw = self._command("GET", key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key: str, value: Any, ttl_seconds: float | None = None):
+        raw = json.dumps(value, ensure_ascii=False)
+        if ttl_seconds:
+            self._command("SET", key, raw, "PX", str(int(ttl_seconds * 1000)))
+        else:
+            self._command("SET", key, raw)
+
+    def delete(self, key: str):
+        self._command("DEL", key)
+
+    def publish_invalidation(self, message: str):
+        self._command("PUBLISH", INVALIDATION_CHANNEL, message)
+
+    def subscribe_invalidations(self, callback: Callable[[str], None]):
+        def listen():
+            while True:
+                try:
+                    sock, reader = self._connect()
+                    sock.settimeout(None)
+                    sock.sendall(self._encode("SUBSCRIBE", INVALIDATION_CHANNEL))
+                    while True:
+                        reply = self._read_reply(reader)
+                        if isinstance(reply, list) and reply and reply[0] == "message":
+                            callback(reply[2])
+                except Exception as e:
+                    print(f"🚨 Redis 무효화 채널 구독 중 오류 발생, 재연결합니다: {e}")
+                    time.sleep(1)
+
+        threading.Thread(target=listen, name="shared-state-invalidation", daemon=True).start()
+
+
+class FirestoreBackend(StateBackend):
+    """
+    Firestore 컬렉션에 값을 저장하는 저장소입니다.
+    캐시 무효화는 무효화 컬렉션에 문서를 추가하고 실시간 리스너로 전파합니다.
+
+    두 컬렉션의 문서는 모두 'expires_at' 필드에 만료 시각을 담습니다. 만료된 문서가 쌓이지 않도록
+    두 컬렉션에 이 필드로 Firestore TTL 정책을 설정해야 합니다. 예:
+        gcloud firestore fields ttls update expires_at --collection-group=shared_state --enable-ttl
+        gcloud firestore fields ttls update expires_at --collection-group=shared_state_invalidations --enable-ttl
+    (TTL 정책은 만료 후 최대 하루 안에 삭제하므로, 조회 시 만료된 문서는 직접 지웁니다.)
+    """
+
+    def __init__(self, db=None):
+        if db is None:
+            from firebase_utils import initialize_firebase
+            db = initialize_firebase()
+        self.db = db
+        self.collection = db.collection("shared_state")
+        self.invalidations = db.collection("shared_state_invalidations")
+
+    @staticmethod
+    def _doc_id(key: str) -> str:
+        # Firestore 문서 ID에는 '/'를 사용할 수 없습니다.
+        return key.replace("/", "|")
+
+    def get(self, key: str) -> Any | None:
+        doc = self.collection.document(self._doc_id(key)).get()
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        expires_at = data.get("expires_at")
+        if expires_at is not None and expires_at < datetime.now(timezone.utc):
+            # 그 사이 다른 워커가 새 값을 저장했다면 지우지 않도록 읽은 시점의 문서일 때만 지웁니다.
+            try:
+                doc.reference.delete(option=self.db.write_option(last_update_time=doc.update_time))
+            except Exception:
+                pass
+            return None
+        return json.loads(data["value"])
+
+    def set(self, key: str, value: Any, ttl_seconds: float | None = None):
+        data = {"value": json.dumps(value, ensure_ascii=False), "expires_at": None}
+        if ttl_seconds:
+            data["expires_at"] = datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds)
+        self.collection.document(self._doc_id(key)).set(data)
+
+    def delete(self, key: str):
+        self.collection.document(self._doc_id(key)).delete()
+
+    def publish_invalidation(self, message: str):
+        now = datetime.now(timezone.utc)
+        self.invalidations.add({
+            "message": message,
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=FIRESTORE_INVALIDATION_RETENTION_SECONDS)
+        })
+
+    def subscribe_invalidations(self, callback: Callable[[str], None]):
+        from google.cloud.firestore_v1.base_query import FieldFilter
+
+        query = self.invalidations.where(
+            filter=FieldFilter("created_at", ">", datetime.now(timezone.utc))
+        )
+
+        def on_snapshot(_, changes, __):
+            for change in changes:
+                if change.type.name == "ADDED":
+                    callback(change.document.to_dict().get("message", ""))
+
+        query.on_snapshot(on_snapshot)
+
+
+class TieredCache:
+    """
+    프로세스 로컬 L1 캐시와 공유 L2 저장소를 묶은 2단계 캐시입니다.
+    값을 쓰거나 지우면 다른 워커/노드에 무효화 메시지를 보내 그쪽 L1을 비웁니다.
+    """
+
+    def __init__(self, l2: StateBackend, l1_ttl_seconds: float = 5.0):
+        self.l1 = InProcessBackend(max_entries=int(os.getenv("SHARED_STATE_MEMORY_MAX_ENTRIES", DEFAULT_MEMORY_MAX_ENTRIES)))
+        self.l2 = l2
+        self.l1_ttl_seconds = l1_ttl_seconds
+        self.origin = uuid.uuid4().hex[:8]
+        self.stats = {"l1_hits": 0, "l2_hits": 0, "misses": 0}
+        if l2 is not None:
+            l2.subscribe_invalidations(self._on_invalidation)
+
+    @property
+    def is_shared(self) -> bool:
+        """다른 프로세스/노드와 값을 공유하는 저장소(redis/firestore)를 사용하는지 여부"""
+        return self.l2 is not None
+
+    def _on_invalidation(self, message: str):
+        origin, _, key = message.partition("|")
+        if origin != self.origin:
+            self.l1.delete(key)
+
+    def _l1_ttl(self, ttl_seconds: float | None) -> float:
+        return min(self.l1_ttl_seconds, ttl_seconds) if ttl_seconds else self.l1_ttl_seconds
+
+    def get(self, key: str) -> Any | None:
+        value = self.l1.get(key)
+        if value is not None:
+            self.stats["l1_hits"] += 1
+            return value
+        if self.l2 is not None:
+            try:
+                value = self.l2.get(key)
+            except Exception as e:
+                print(f"🚨 공유 캐시 조회 실패 ({key}): {e}")
+                value = None
+            if value is not None:
+                self.stats["l2_hits"] += 1
+                self.l1.set(key, value, self.l1_ttl_seconds)
+                return value
+        self.stats["misses"] += 1
+        return None
+
+    def set(self, key: str, value: Any, ttl_seconds: float | None = None):
+        if self.l2 is None:
+            # 공유 저장소가 없으면 L1이 유일한 저장소이므로 요청된 TTL을 그대로 사용합니다.
+            self.l1.set(key, value, ttl_seconds)
+            return
+        self.l1.set(key, value, self._l1_ttl(ttl_seconds))
+        try:
+            self.l2.set(key, value, ttl_seconds)
+            self.l2.publish_invalidation(f"{self.origin}|{key}")
+        except Exception as e:
+            print(f"🚨 공유 캐시 저장 실패 ({key}): {e}")
+
+    def delete(self, key: str):
+        self.l1.delete(key)
+        if self.l2 is None:
+            return
+        try:
+            self.l2.delete(key)
+            self.l2.publish_invalidation(f"{self.origin}|{key}")
+        except Exception as e:
+            print(f"🚨 공유 캐시 삭제 실패 ({key}): {e}")
+
+    def get_or_load(self, key: str, loader: Callable[[], Any], ttl_seconds: float | None = None) -> Any:
+        """캐시에 값이 없으면 loader를 호출해 값을 채운 뒤 반환합니다."""
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            if value is not None:
+                self.set(key, value, ttl_seconds)
+        return value
+
+
+_shared_state: TieredCache | None = None
+_shared_state_lock = threading.Lock()
+
+
+def get_shared_state() -> TieredCache:
+    """
+    SHARED_STATE_BACKEND 환경 변수에 따라 공유 상태 캐시를 한 번만 생성하여 반환합니다.
+    - memory (기본값): 프로세스 내부 메모리만 사용
+    - redis: REDIS_URL(기본값 redis://localhost:6379/0)의 Redis 호환 서버 사용
+    - firestore: Firestore 'shared_state' 컬렉션 사용
+
+    memory 백엔드는 프로세스마다 따로 저장되므로, proactive_scheduler.py CLI처럼 별도 프로세스로 실행하는
+    워커가 서버와 캐시를 공유하려면 redis 또는 firestore 백엔드를 사용해야 합니다.
+    """
+    global _shared_state
+    if _shared_state is None:
+        with _shared_state_lock:
+            if _shared_state is None:
+                backend_name = os.getenv("SHARED_STATE_BACKEND", "memory").lower()
+                l1_ttl = float(os.getenv("SHARED_STATE_L1_TTL_SECONDS", "5"))
+                if backend_name == "redis":
+                    l2 = RedisBackend(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+                elif backend_name == "firestore":
+                    l2 = FirestoreBackend()
+                else:
+                    l2 = None
+                _shared_state = TieredCache(l2, l1_ttl_seconds=l1_ttl)
+                print(f"🗄️ 공유 상태 저장소를 '{backend_name}' 백엔드로 초기화했습니다.")
+    return _shared_state
@@ -1,3 +1,7 @@
+import json
+from datetime import date, datetime
+
+
 def is_data_sufficient(health_data: dict | None) -> bool:
     """
     전달된 건강 데이터가 AI 분석을 수행하기에 충분한지 확인합니다.
@@ -42,4 +46,161 @@ def get_health_questionnaire() -> str:
     5. 현재 가장 개선하고 싶은 건강 목표가 있다면 알려주세요. (예: 체중 감량, 숙면)
     
     답변을 모두 입력해주시면 바로 분석해 드릴게요!
-    """
\ No newline at end of file
+    """
+
+def parse_ai_response(ai_raw_response: str) -> dict | None:
+    """
+    AI 응답 문자열을 JSON 객체로 파싱합니다.
+    모델이 ```json 코드 블록으로 감싸서 응답한 경우에도 처리하며, 실패하면 None을 반환합니다.
+    """
+    text = ai_raw_response.strip()
+    if text.startswith("```"):
+        text = text.strip("`").strip()
+        if text.startswith("json"):
+            text = text[len("json"):].strip()
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def build_notification_content(chat_text: str) -> tuple[str, str] | None:
+    """
+    AI 답변 내용에 위험 요소가 포함된 경우, 앱에 보낼 알림의 (제목, 본문)을 반환합니다.
+    알림이 필요 없으면 None을 반환합니다.
+    """
+    if "[🚨 위험 요소]" in chat_text:
+        if "수면" in chat_text:
+            return "수면 부족 경고", "어젯밤 수면의 질이 좋지 않았습니다. 앱에서 확인해보세요."
+        elif "스트레스" in chat_text:
+            return "높은 스트레스 감지", "스트레스 지수가 높게 측정되었습니다. 휴식이 필요합니다."
+    return None
+
+
+# 분석 기록과 추이 조회에 사용하는 수치 지표 이름 목록
+HEALTH_METRICS = [
+    "sleep_duration_minutes", "deep_sleep_minutes", "rem_sleep_minutes", "light_sleep_minutes",
+    "awake_minutes", "total_steps", "exercise_minutes", "calories_burned", "avg_heart_rate",
+    "max_heart_rate", "avg_stress", "calorie_intake", "hydration_liters", "avg_systolic",
+    "avg_diastolic", "min_oxygen_saturation"
+]
+
+
+def _average(values: list) -> float | None:
+    values = [v for v in values if isinstance(v, (int, float))]
+    return round(sum(values) / len(values), 2) if values else None
+
+
+def _minutes_between(start: str | None, end: str | None) -> float | None:
+    if not start or not end:
+        return None
+    try:
+        started = datetime.fromisoformat(start.replace("Z", "+00:00"))
+        ended = datetime.fromisoformat(end.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return (ended - started).total_seconds() / 60
+
+
+def extract_health_metrics(health_data: dict | None) -> dict:
+    """
+    건강 데이터(sample_data.json 형식)에서 추이 분석에 사용할 수치 지표만 뽑아 반환합니다.
+    값을 계산할 수 없는 지표는 결과에 포함하지 않습니다.
+    """
+    if not health_data:
+        return {}
+    metrics = {}
+
+    sleep = health_data.get("sleep_data") or {}
+    if sleep.get("duration_minutes") is not None:
+        metrics["sleep_duration_minutes"] = sleep["duration_minutes"]
+    stage_keys = {"DEEP": "deep_sleep_minutes", "REM": "rem_sleep_minutes",
+                  "LIGHT": "light_sleep_minutes", "AWAKE": "awake_minutes"}
+    for stage in sleep.get("stages") or []:
+        key = stage_keys.get(str(stage.get("stage", "")).upper())
+        if key and isinstance(stage.get("duration_minutes"), (int, float)):
+            metrics[key] = metrics.get(key, 0) + stage["duration_minutes"]
+
+    exercises = health_data.get("exercise_data") or []
+    if exercises:
+        steps = [e.get("stats", {}).get("total_steps") for e in exercises]
+        if any(isinstance(s, (int, float)) for s in steps):
+            metrics["total_steps"] = sum(s for s in steps if isinstance(s, (int, float)))
+        calories = [e.get("stats", {}).get("calories_burned") for e in exercises]
+        if any(isinstance(c, (int, float)) for c in calories):
+            metrics["calories_burned"] = sum(c for c in calories if isinstance(c, (int, float)))
+        durations = [_minutes_between(e.get("start_time"), e.get("end_time")) for e in exercises]
+        if any(d is not None for d in durations):
+            metrics["exercise_minutes"] = round(sum(d for d in durations if d is not None), 2)
+
+    timeseries = health_data.get("timeseries_data") or []
+    heart_rates = [p.get("heart_rate") for p in timeseries if isinstance(p.get("heart_rate"), (int, float))]
+    if heart_rates:
+        metrics["avg_heart_rate"] = _average(heart_rates)
+        metrics["max_heart_rate"] = max(heart_rates)
+    avg_stress = _average([p.get("stress") for p in timeseries])
+    if avg_stress is not None:
+        metrics["avg_stress"] = avg_stress
+
+    nutrition = health_data.get("nutrition_data") or {}
+    meal_calories = [m.get("calories") for m in nutrition.get("meals") or []]
+    if any(isinstance(c, (int, float)) for c in meal_calories):
+        metrics["calorie_intake"] = sum(c for c in meal_calories if isinstance(c, (int, float)))
+    if isinstance(nutrition.get("hydration_liters"), (int, float)):
+        metrics["hydration_liters"] = nutrition["hydration_liters"]
+
+    vitals = health_data.get("vitals_data") or {}
+    blood_pressure = vitals.get("blood_pressure") or []
+    for field, key in (("systolic", "avg_systolic"), ("diastolic", "avg_diastolic")):
+        value = _average([bp.get(field) for bp in blood_pressure])
+        if value is not None:
+            metrics[key] = value
+    oxygen = [o.get("percentage") for o in vitals.get("oxygen_saturation") or []
+              if isinstance(o.get("percentage"), (int, float))]
+    if oxygen:
+        metrics["min_oxygen_saturation"] = min(oxygen)
+
+    return metrics
+
+
+def _date_part(value) -> str | None:
+    if not isinstance(value, str) or len(value) < 10:
+        return None
+    try:
+        return date.fromisoformat(value[:10]).isoformat()
+    except ValueError:
+        return None
+
+
+def health_data_date(health_data: dict | None) -> str | None:
+    """
+    건강 데이터가 어느 날짜의 데이터인지 'YYYY-MM-DD'로 반환합니다.
+    앱이 보낸 data_date를 우선 사용하고, 없으면 운동/시계열/혈압 기록 시각, 수면 종료 시각 순으로 찾습니다.
+    """
+    if not health_data:
+        return None
+    candidates = [health_data.get("data_date")]
+    candidates += [session.get("start_time") for session in health_data.get("exercise_data") or []]
+    candidates += [point.get("time") for point in health_data.get("timeseries_data") or []]
+    candidates += [bp.get("time") for bp in (health_data.get("vitals_data") or {}).get("blood_pressure") or []]
+    candidates.append((health_data.get("sleep_data") or {}).get("end_time"))
+    for candidate in candidates:
+        data_date = _date_part(candidate)
+        if data_date:
+            return data_date
+    return None
+
+
+def summarize_metric_trend(metric: str, rollups: list[dict]) -> dict:
+    """
+    기간별 롤업 목록(오래된 순)으로부터 첫 기간 대비 마지막 기간의 변화량을 계산합니다.
+    """
+    points = [r for r in rollups if r.get("average") is not None]
+    summary = {"metric": metric, "periods": rollups, "change": None, "change_percent": None}
+    if len(points) >= 2:
+        first, last = points[0]["average"], points[-1]["average"]
+        summary["change"] = round(last - first, 2)
+        if first:
+            summary["change_percent"] = round((last - first) / first * 100, 1)
+    return summary
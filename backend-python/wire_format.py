@@ -0,0 +1,228 @@
+# wire_format.py
+
+import json
+import zlib
+
+# 선택적 의존성: 설치되어 있으면 더 빠른 JSON 직렬화와 바이너리 인코딩(MessagePack/CBOR)을 사용합니다.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+CBOR_MEDIA_TYPE = "application/cbor"
+
+# 압축 해제 후 요청 본문의 최대 크기 (압축 폭탄 방지)
+MAX_DECOMPRESSED_BODY_BYTES = 10 * 1024 * 1024
+# 이보다 작은 응답은 압축하지 않습니다.
+MIN_COMPRESS_BYTES = 1024
+
+
+class UnsupportedMediaType(Exception):
+    pass
+
+
+def dumps_json(data) -> bytes:
+    """JSON을 바이트로 직렬화합니다. orjson이 있으면 orjson을 사용합니다."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def dumps_json_text(data) -> str:
+    """프롬프트 등에 넣을 JSON 문자열을 만듭니다. (한글이 이스케이프되지 않음)"""
+    return dumps_json(data).decode("utf-8")
+
+
+def _media_type(content_type: str | None) -> str:
+    return (content_type or JSON_MEDIA_TYPE).split(";")[0].strip().lower()
+
+
+def _parse_qvalues(header: str | None) -> list[str]:
+    """
+    Accept/Accept-Encoding 헤더를 q 값이 높은 순서의 항목 목록으로 바꿉니다. (q=0인 항목은 허용하지 않는다는 뜻이므로 제외)
+    q 값이 같으면 헤더에 적힌 순서를 유지합니다.
+    """
+    items = []
+    for index, part in enumerate((header or "").split(",")):
+        name, *params = [token.strip() for token in part.split(";")]
+        if not name:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            items.append((-q, index, name.lower()))
+    return [name for _, _, name in sorted(items)]
+
+
+def decode_body(body: bytes, content_type: str | None):
+    """Content-Type에 따라 요청 본문을 JSON, MessagePack 또는 CBOR로 해석합니다."""
+    media_type = _media_type(content_type)
+    if media_type in MSGPACK_MEDIA_TYPES:
+        if msgpack is None:
+            raise UnsupportedMediaType("MessagePack is not available on this server")
+        # 요청 본문은 JSON으로 표현할 수 있어야 하므로, 문자열이 아닌 맵 키와 bin(바이트) 값은 받지 않습니다.
+        try:
+            return msgpack.unpackb(body, raw=False, strict_map_key=True, max_bin_len=0)
+        except TypeError as e:
+            raise ValueError(str(e)) from e
+    if media_type == CBOR_MEDIA_TYPE:
+        if cbor2 is None:
+            raise UnsupportedMediaType("CBOR is not available on this server")
+        # cbor2 6.x의 CBORDecodeError는 ValueError가 아니므로, 다른 형식과 같이 ValueError로 바꿔 400으로 응답합니다.
+        try:
+            return cbor2.loads(body)
+        except cbor2.CBORDecodeError as e:
+            raise ValueError(str(e)) from e
+    if media_type == JSON_MEDIA_TYPE or media_type.endswith("+json"):
+        return orjson.loads(body) if orjson is not None else json.loads(body)
+    raise UnsupportedMediaType(f"Unsupported Content-Type: {media_type}")
+
+
+def encode_body(data, accept: str | None) -> tuple[bytes, str]:
+    """Accept 헤더에 맞춰 응답을 인코딩하고 (본문, Content-Type)을 반환합니다. 기본값은 JSON입니다."""
+    for media_type in _parse_qvalues(accept):
+        if media_type in MSGPACK_MEDIA_TYPES and msgpack is not None:
+            return msgpack.packb(data, use_bin_type=True), media_type
+        if media_type == CBOR_MEDIA_TYPE and cbor2 is not None:
+            return cbor2.dumps(data), CBOR_MEDIA_TYPE
+    return dumps_json(data), JSON_MEDIA_TYPE
+
+
+def _decompress(body: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif body[:1] == b"\x78":
+        # zlib 헤더가 있는 deflate
+        decompressor = zlib.decompressobj()
+    else:
+        # 헤더 없는 raw deflate
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    data = decompressor.decompress(body, MAX_DECOMPRESSED_BODY_BYTES + 1)
+    if len(data) > MAX_DECOMPRESSED_BODY_BYTES or decompressor.unconsumed_tail:
+        raise ValueError("Decompressed request body is too large")
+    return data
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def _preferred_encoding(accept_encoding: str) -> str | None:
+    """클라이언트가 허용하는(q>0) 인코딩 중 가장 선호하는 gzip/deflate를 반환합니다."""
+    encodings = _parse_qvalues(accept_encoding)
+    for encoding in encodings:
+        if encoding in ("gzip", "deflate"):
+            return encoding
+        if encoding == "*":
+            # 명시적으로 거부(q=0)하지 않은 인코딩 중에서 고릅니다.
+            refused = {part.split(";")[0].strip().lower() for part in accept_encoding.split(",")} - set(encodings)
+            return next((candidate for candidate in ("gzip", "deflate") if candidate not in refused), None)
+    return None
+
+
+class CompressionMiddleware:
+    """
+    gzip/deflate로 압축된 요청 본문(Content-Encoding)을 풀고,
+    클라이언트가 지원하면(Accept-Encoding) 응답 본문을 gzip/deflate로 압축하는 ASGI 미들웨어입니다.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+        content_encoding = headers.get("content-encoding", "").strip().lower()
+        if content_encoding in ("gzip", "deflate"):
+            body = b""
+            more_body = True
+            while more_body:
+                message = await receive()
+                body += message.get("body", b"")
+                more_body = message.get("more_body", False)
+            try:
+                body = _decompress(body, content_encoding)
+            except (zlib.error, ValueError) as e:
+                await self._send_error(send, 400, f"Invalid compressed request body: {e}")
+                return
+
+            scope = dict(scope)
+            scope["headers"] = [
+                (key, value) for key, value in scope["headers"]
+                if key.lower() not in (b"content-encoding", b"content-length")
+            ] + [(b"content-length", str(len(body)).encode("latin-1"))]
+            delivered = False
+
+            async def receive():
+                nonlocal delivered
+                if delivered:
+                    return {"type": "http.disconnect"}
+                delivered = True
+                return {"type": "http.request", "body": body, "more_body": False}
+
+        response_encoding = _preferred_encoding(headers.get("accept-encoding", ""))
+        if response_encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        chunks = []
+
+        async def send_compressed(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+
+            body = b"".join(chunks)
+            response_headers = [(k, v) for k, v in start_message.get("headers", []) if k.lower() != b"content-length"]
+            already_encoded = any(k.lower() == b"content-encoding" for k, _ in response_headers)
+            if len(body) >= MIN_COMPRESS_BYTES and not already_encoded:
+                body = _compress(body, response_encoding)
+                response_headers += [(b"content-encoding", response_encoding.encode("latin-1")),
+                                     (b"vary", b"Accept-Encoding")]
+            response_headers.append((b"content-length", str(len(body)).encode("latin-1")))
+            await send({**start_message, "headers": response_headers})
+            await send({"type": "http.response.body", "body": body, "more_body": False})
+
+        await self.app(scope, receive, send_compressed)
+
+    @staticmethod
+    async def _send_error(send, status: int, detail: str):
+        body = dumps_json({"detail": detail})
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", JSON_MEDIA_TYPE.encode("latin-1")),
+                        (b"content-length", str(len(body)).encode("latin-1"))]
+        })
+        await send({"type": "http.response.body", "body": body})